@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2026, chys <admin@CHYS.INFO>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+#   Neither the name of chys <admin@CHYS.INFO> nor the names of other
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+'''Benchmark the tree-walking, file-hashing tools on synthetic trees.
+
+Generates a source and a destination tree in a temporary directory and
+times the phases of copy-identical-mtime.py and
+gentoo/find-user-modified-files.py.  Each tool runs in a forked child so
+that its peak RSS can be reported separately.  Timings are with a warm
+page cache, since the trees have just been written.
+'''
+
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(relpath, name):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(HERE, relpath))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def gen_tree(root, args):
+    # Source and destination trees with the same layout.  A dup_ratio
+    # fraction of destination files are identical to their source (but
+    # with a different mtime); the rest differ in one byte.
+    rnd = random.Random(args.seed)
+    src = os.path.join(root, 'src')
+    dst = os.path.join(root, 'dst')
+    log_min = math.log(max(args.min_size, 1))
+    log_max = math.log(max(args.max_size, args.min_size, 1))
+
+    total = 0
+    for n in range(args.files):
+        parts = ['d{}'.format(rnd.randrange(args.fanout))
+                 for _ in range(args.depth)]
+        rel = os.path.join(*parts, 'f{}.dat'.format(n))
+        size = int(math.exp(rnd.uniform(log_min, log_max)))
+        if args.min_size == 0 and rnd.random() < 0.01:
+            size = 0
+        data = bytearray(rnd.getrandbits(8 * size).to_bytes(size, 'little'))
+        total += size
+
+        for top in (src, dst):
+            os.makedirs(os.path.dirname(os.path.join(top, rel)),
+                        exist_ok=True)
+        with open(os.path.join(src, rel), 'wb') as f:
+            f.write(data)
+        if data and rnd.random() >= args.dup_ratio:
+            data[rnd.randrange(size)] ^= 0xff
+        with open(os.path.join(dst, rel), 'wb') as f:
+            f.write(data)
+        os.utime(os.path.join(src, rel), ns=(10 ** 18, 10 ** 18))
+
+    return src, dst, total
+
+
+def run_forked(func, *args):
+    # Run func(*args) in a child process.  Returns its (JSON-serializable)
+    # result and the child's peak RSS in KiB.
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            res = func(*args)
+            with os.fdopen(w, 'w') as f:
+                json.dump(res, f)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+
+    os.close(w)
+    with os.fdopen(r) as f:
+        data = f.read()
+    _, status, rusage = os.wait4(pid, 0)
+    if status != 0:
+        sys.exit('Benchmark child failed')
+    return json.loads(data), rusage.ru_maxrss
+
+
+def timed(phases, name, func, *args):
+    start = time.monotonic()
+    res = func(*args)
+    phases.append((name, time.monotonic() - start))
+    return res
+
+
+def bench_copy_identical_mtime(src, dst, tmpdir, args):
+    cim = load_script('copy-identical-mtime.py', 'copy_identical_mtime')
+    phases = []
+    bytes_read = {}
+    # Matching runs with --pretend, and the first pass writes a plan, so
+    # that setting the mtimes is timed on its own as the apply phase
+    plan = io.StringIO()
+
+    def match(name, cache, plan=None):
+        stats = cim.Stats()
+        hasher = cim.Hasher(args.digest, cache, stats)
+        if phases:
+            index = cim.init_src_index(src, None, stats)
+        else:
+            index = timed(phases, 'index', cim.init_src_index,
+                          src, None, stats)
+        with open(os.devnull, 'w') as null, \
+                contextlib.redirect_stdout(null):
+            timed(phases, name, cim.copy, index,
+                  cim.scan_dst(dst, None, stats), cim.Output(plan=plan),
+                  True, hasher, args.jobs)
+        bytes_read[name] = stats.counts['bytes']
+
+    match('match', cim.NullCache(), plan)
+    cache = cim.HashCache(os.path.join(tmpdir, 'cache.sqlite'), args.digest)
+    match('match (cache cold)', cache)
+    match('match (cache warm)', cache)
+    cache.close()
+
+    hasher = cim.Hasher(args.digest, cim.NullCache(), cim.Stats())
+    plan.seek(0)
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        timed(phases, 'apply', cim.apply_plan, plan, cim.Output(), False,
+              hasher)
+
+    return [(name, seconds, bytes_read.get(name, 0))
+            for name, seconds in phases]
+
+
+def bench_find_user_modified_files(src, dst, args):
+    fumf = load_script(os.path.join('gentoo', 'find-user-modified-files.py'),
+                       'find_user_modified_files')
+    phases = []
+
+    # Pretend src was installed by portage, and see what changed in dst
+    installed = {}
+    nbytes = 0
+    for dirname, subdirs, files in os.walk(src):
+        for fname in files:
+            path = os.path.join(dirname, fname)
+            with open(path, 'rb') as f:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            rel = os.path.relpath(path, src)
+            installed[os.path.join(dst, rel)] = \
+                fumf.FileDetail(fumf.FileType.OBJ, md5)
+            nbytes += os.path.getsize(path)
+
+    timed(phases, 'scan', lambda: list(fumf.find_files(dst, {})))
+    timed(phases, 'hash', lambda: list(fumf.find_files(dst, installed)))
+    return [(name, seconds, nbytes if name == 'hash' else 0)
+            for name, seconds in phases]
+
+
+def report(tool, results, maxrss, nfiles):
+    print('{} (peak RSS {} KiB)'.format(tool, maxrss))
+    for name, seconds, nbytes in results:
+        print('  {:<20} {:8.3f} s {:12.0f} files/s {:10.1f} MB/s'.format(
+            name, seconds, nfiles / seconds if seconds else 0,
+            nbytes / seconds / 1e6 if seconds else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the file-hashing tools on synthetic trees')
+    parser.add_argument('-n', '--files', type=int, default=10000,
+                        help='Number of files (default: %(default)s)')
+    parser.add_argument('--min-size', type=int, default=0,
+                        help='Minimum file size (default: %(default)s)')
+    parser.add_argument('--max-size', type=int, default=1024 * 1024,
+                        help='Maximum file size; sizes are log-uniform '
+                             '(default: %(default)s)')
+    parser.add_argument('--dup-ratio', type=float, default=0.9,
+                        help='Fraction of identical files '
+                             '(default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Directory depth (default: %(default)s)')
+    parser.add_argument('--fanout', type=int, default=8,
+                        help='Subdirectories per level (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Hashing threads for copy-identical-mtime')
+    parser.add_argument('-d', '--digest', default='md5',
+                        help='Digest for copy-identical-mtime')
+    parser.add_argument('--dir', help='Where to create the temporary trees')
+    parser.add_argument('--keep', action='store_true',
+                        help='Don\'t remove the generated trees')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench-hash-tools-', dir=args.dir)
+    try:
+        start = time.monotonic()
+        src, dst, total = gen_tree(tmpdir, args)
+        print('Generated {} files, {:.1f} MB per tree in {:.1f} s ({})'
+              .format(args.files, total / 1e6, time.monotonic() - start,
+                      tmpdir))
+
+        results, maxrss = run_forked(bench_copy_identical_mtime,
+                                     src, dst, tmpdir, args)
+        report('copy-identical-mtime.py', results, maxrss, args.files)
+
+        results, maxrss = run_forked(bench_find_user_modified_files,
+                                     src, dst, args)
+        report('find-user-modified-files.py', results, maxrss, args.files)
+    finally:
+        if not args.keep:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
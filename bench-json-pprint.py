@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2026, chys <admin@CHYS.INFO>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+#   Neither the name of chys <admin@CHYS.INFO> nor the names of other
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+'''Benchmark the parsers of json_pprint.py on synthetic documents.
+
+Generates the same records as standard JSON, JSON with property names
+without quotes, LPC, and standard JSON with one bad member at the very
+end.  Each is parsed by tolerant_loads() and by the chain of fix-up
+passes it replaced, and the results are checked to be the same.  The
+best of several runs is reported.
+'''
+
+import argparse
+from collections import OrderedDict
+import gc
+import importlib.util
+import json
+import os
+import random
+import re
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(relpath, name):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(HERE, relpath))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+# The fix-up chain, as json_pprint.py had it
+
+def lpc_2_json(lpc_str):
+    convert_dict = [
+        ('([', '{'),
+        (',])', '}'),
+        ('])', '}'),
+
+        ('({', '['),
+        (',})', ']'),
+        ('})', ']'),
+    ]
+
+    for old, new in convert_dict:
+        lpc_str = lpc_str.replace(old, new)
+
+    return lpc_str
+
+
+def fix_json(src):
+    return re.sub(r'([\{,]\s*)(\w+)(?=\s*:)', r'\1"\2"', src)
+
+
+def chain(jp, src):
+    try:
+        return jp.json_loads(src)
+    except ValueError:
+        pass
+    try:
+        return jp.json_loads(fix_json(src))
+    except ValueError:
+        return jp.json_loads(fix_json(lpc_2_json(src)))
+
+
+def gen_records(args):
+    rnd = random.Random(args.seed)
+    return [OrderedDict([
+        ('id', i),
+        ('name', 'item {}'.format(i)),
+        ('tags', rnd.sample(['a', 'b', 'c', 'd'], rnd.randrange(4))),
+        ('score', rnd.random()),
+        ('nested', OrderedDict([('x', [1, 2, None]), ('ok', True)])),
+    ]) for i in range(args.records)]
+
+
+def to_lpc(value):
+    # With the trailing commas that LPC's save_object() writes
+    if isinstance(value, dict):
+        return '([' + ''.join('{}:{},'.format(json.dumps(k), to_lpc(v))
+                              for k, v in value.items()) + '])'
+    if isinstance(value, list):
+        return '({' + ''.join(to_lpc(v) + ',' for v in value) + '})'
+    return json.dumps(value)
+
+
+def gen_documents(records):
+    std = json.dumps(records)
+    return [
+        ('json', std),
+        ('unquoted keys', re.sub(r'"(\w+)":', r'\1:', std)),
+        ('lpc', to_lpc(records)),
+        ('bad member at end', std[:-1] + ', {late: 1}]'),
+    ]
+
+
+def best_time(func, src, repeat):
+    # With the garbage collector off, as timeit does, or the objects kept
+    # alive from earlier runs would make every later one slower
+    best = None
+    for _ in range(repeat):
+        res = None
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            res = func(src)
+            seconds = time.perf_counter() - start
+        finally:
+            gc.enable()
+        if best is None or seconds < best:
+            best = seconds
+    return res, best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the parsers of json_pprint.py')
+    parser.add_argument('-n', '--records', type=int, default=100000,
+                        help='Records per document (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs per parser (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    jp = load_script('json_pprint.py', 'json_pprint')
+    records = gen_records(args)
+
+    print('{:<20} {:>8} {:>16} {:>16}'.format(
+        'document', 'MB', 'fix-up chain', 'tolerant_loads'))
+    for name, src in gen_documents(records):
+        mb = len(src.encode()) / 1e6
+        old, old_seconds = best_time(lambda s: chain(jp, s), src, args.repeat)
+        new, new_seconds = best_time(jp.tolerant_loads, src, args.repeat)
+        if new != old:
+            raise SystemExit('{}: results differ'.format(name))
+        print('{:<20} {:8.1f} {:10.1f} MB/s {:10.1f} MB/s'.format(
+            name, mb, mb / old_seconds, mb / new_seconds))
+
+
+if __name__ == '__main__':
+    main()
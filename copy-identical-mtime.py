@@ -34,110 +34,1071 @@
 
 
 import argparse
+import array
 import binascii
 import collections
+import concurrent.futures
+import contextlib
+import ctypes
 from datetime import datetime
+import errno
 import fnmatch
 import hashlib
+import json
 import os
+import resource
+import select
+import sqlite3
 import stat
+import struct
+import sys
+import threading
+import time
 
-
-File = collections.namedtuple('File', ['path', 'mtime_ns'])
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 SKIP_DIRS = ['.git', '.svn', '.hg']
 
+PARTIAL_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+DIGESTS = {
+    'md5': hashlib.md5,
+    'blake2b': lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash is not None:
+    DIGESTS['xxh128'] = xxhash.xxh3_128
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'copy-identical-mtime', 'hashes.sqlite')
+
+
+class NullCache:
+    hits = 0
+    misses = 0
+
+    def get(self, key):
+        return None
+
+    def put(self, key, h):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashCache(NullCache):
+    # Content hashes keyed by (dev, ino, size, mtime_ns).  Any change to
+    # these and the file is hashed again.  One table per digest algorithm.
+    #
+    # The cache is shared by every run, so writes are kept in memory and
+    # committed BATCH at a time, each batch in a short transaction of its
+    # own; with WAL, readers don't wait for it either.  If the database
+    # fails anyway (say, locked for longer than TIMEOUT seconds), we warn
+    # and go on without the cache rather than die.
+    BATCH = 1000
+    TIMEOUT = 30
+
+    def __init__(self, path, algo='md5'):
+        self.lock = threading.Lock()
+        self.table = 'hashes' if algo == 'md5' else 'hashes_' + algo
+        self.now = int(time.time())
+        self.hits = 0
+        self.misses = 0
+        self.pending = {}  # key -> hash, not written yet
+        self.touched = []  # (dev, ino) whose used time is to be updated
+        self.db = None
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        try:
+            self.db = sqlite3.connect(path, timeout=self.TIMEOUT,
+                                      check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS {} ('
+                                'dev INTEGER NOT NULL, '
+                                'ino INTEGER NOT NULL, '
+                                'size INTEGER NOT NULL, '
+                                'mtime_ns INTEGER NOT NULL, '
+                                'hash BLOB NOT NULL, '
+                                'used INTEGER NOT NULL, '
+                                'PRIMARY KEY (dev, ino)) WITHOUT ROWID'
+                                .format(self.table))
+        except sqlite3.Error as e:
+            self.disable(e)
+
+    def disable(self, e):
+        print('Hash cache disabled: {}'.format(e), file=sys.stderr)
+        if self.db is not None:
+            try:
+                self.db.close()
+            except sqlite3.Error:
+                pass
+            self.db = None
+
+    def get(self, key):
+        with self.lock:
+            h = self.pending.get(key)
+            if h is None and self.db is not None:
+                try:
+                    row = self.db.execute(
+                        'SELECT hash, used FROM {} WHERE dev = ? AND '
+                        'ino = ? AND size = ? AND mtime_ns = ?'
+                        .format(self.table),
+                        key).fetchone()
+                except sqlite3.Error as e:
+                    self.disable(e)
+                    row = None
+                if row is not None:
+                    h, used = row
+                    if used != self.now:
+                        self.touched.append(key[:2])
+                        self._write_batch()
+            if h is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return h
+
+    def put(self, key, h):
+        with self.lock:
+            if self.db is not None:
+                self.pending[key] = h
+                self._write_batch()
+
+    def _write_batch(self):
+        if len(self.pending) + len(self.touched) >= self.BATCH:
+            self._write()
+
+    def _write(self):
+        # With the lock held
+        if self.db is not None and (self.pending or self.touched):
+            try:
+                with self.db:
+                    self.db.executemany(
+                        'INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?, ?)'
+                        .format(self.table),
+                        [key + (h, self.now)
+                         for key, h in self.pending.items()])
+                    self.db.executemany(
+                        'UPDATE {} SET used = ? WHERE dev = ? AND ino = ?'
+                        .format(self.table),
+                        [(self.now,) + k for k in self.touched])
+            except sqlite3.Error as e:
+                self.disable(e)
+        self.pending.clear()
+        self.touched = []
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def evict(self, max_age_days):
+        tables = [row[0] for row in self.db.execute(
+            'SELECT name FROM sqlite_master WHERE type = \'table\'')]
+        n = 0
+        for table in tables:
+            cur = self.db.execute(
+                'DELETE FROM {} WHERE used < ?'.format(table),
+                (self.now - int(max_age_days * 86400),))
+            n += cur.rowcount
+        self.db.commit()
+        self.db.execute('VACUUM')
+        return n
+
+    def close(self):
+        with self.lock:
+            self._write()
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class Stats:
+    # Syscall and byte counters plus per-phase wall time, for --stats.
+    # Counters are updated from hashing threads, hence the lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.phases = []
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def report(self, file=sys.stderr):
+        for name, seconds in self.phases:
+            print('{:>10}: {:.3f} s'.format(name, seconds), file=file)
+        for key in ('getdents', 'stat', 'open', 'read', 'utime'):
+            print('{:>10}: {} calls'.format(key, self.counts[key]), file=file)
+        print('{:>10}: {}'.format('bytes', self.counts['bytes']), file=file)
+
+
+class Hasher:
+    def __init__(self, algo='md5', cache=None, stats=None):
+        self.new = DIGESTS[algo]
+        self.cache = NullCache() if cache is None else cache
+        self.stats = Stats() if stats is None else stats
+
+    def _stream(self, f, h, limit=-1):
+        # Feed f into h in CHUNK_SIZE pieces through one reusable buffer,
+        # so memory use doesn't depend on file size.  Negative limit means
+        # read to EOF.
+        view = memoryview(bytearray(CHUNK_SIZE))
+        reads = nbytes = 0
+        while limit:
+            n = f.readinto(view[:limit] if 0 < limit < CHUNK_SIZE else view)
+            reads += 1
+            if not n:
+                break
+            h.update(view[:n])
+            nbytes += n
+            limit -= n
+        self.stats.add('read', reads)
+        self.stats.add('bytes', nbytes)
+        return h
+
+    def _open(self, path):
+        self.stats.add('open')
+        return open(path, 'rb', buffering=0)
+
+    def full(self, path):
+        # Callers look in the cache first, and update it
+        with self._open(path) as f:
+            return self._stream(f, self.new()).digest()
+
+    def partial(self, path, size):
+        # Hash of the first and last PARTIAL_SIZE bytes.  Only meaningful
+        # for files larger than 2 * PARTIAL_SIZE; smaller ones are hashed
+        # in full.
+        h = self.new()
+        with self._open(path) as f:
+            self._stream(f, h, PARTIAL_SIZE)
+            f.seek(size - PARTIAL_SIZE)
+            self._stream(f, h, PARTIAL_SIZE)
+        return h.digest()
+
+
+class DigestGroup:
+    # Hash-join state for one group of source files (same name and size,
+    # or just same size when matching by content).  `table` maps full
+    # digest to the preferred source entry.  Files whose digest is known up
+    # front (cached, or small enough to hash outright) go straight into it
+    # and set `direct`; larger ones wait in `buckets`, keyed by head/tail
+    # hash, until a destination file with the same partial hash asks for
+    # them.  `resolved` records the partial hashes already asked for.
+    __slots__ = ('lock', 'table', 'direct', 'pending', 'buckets', 'resolved')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.table = {}
+        self.direct = False
+        self.pending = []
+        self.buckets = None
+        self.resolved = set()
+
+    def unresolved(self):
+        with self.lock:
+            return bool(self.pending or self.buckets)
+
+
+class SrcIndex:
+    # Compact index of the source tree.  Each directory name is stored
+    # once; per-file fields live in parallel arrays indexed by file number.
+    # Files in the same group are chained through `next`, with the most
+    # recently added one in `heads`.
+    def __init__(self, by_content=False):
+        self.by_content = by_content
+        self.dirs = []
+        self.dir_ids = array.array('L')
+        self.names = []
+        self.sizes = array.array('Q')
+        self.mtimes = array.array('q')
+        self.devs = array.array('Q')
+        self.inos = array.array('Q')
+        self.next = array.array('q')
+        self.heads = {}
+        self.groups = {}
+        self.dead = set()  # Entries superseded in --watch mode
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def group(self, name, size):
+        # None for files that aren't matched at all.  By content alone,
+        # every empty file would match every other one.
+        if not self.by_content:
+            return (name, size)
+        return size if size else None
+
+    def add_dir(self, dirname):
+        self.dirs.append(dirname)
+        return len(self.dirs) - 1
+
+    def add(self, dir_id, name, st):
+        group = self.group(name, st.st_size)
+        if group is None:
+            return
+        i = len(self.names)
+        name = sys.intern(name)
+        self.dir_ids.append(dir_id)
+        self.names.append(name)
+        self.sizes.append(st.st_size)
+        self.mtimes.append(st.st_mtime_ns)
+        self.devs.append(st.st_dev)
+        self.inos.append(st.st_ino)
+        self.next.append(self.heads.get(group, -1))
+        self.heads[group] = i
+        self.groups.pop(group, None)
+
+    def retire(self, i):
+        self.dead.add(i)
+        self.groups.pop(self.group(self.names[i], self.sizes[i]), None)
+
+    def candidates(self, group):
+        res = []
+        i = self.heads.get(group, -1)
+        while i >= 0:
+            if i not in self.dead:
+                res.append(i)
+            i = self.next[i]
+        res.reverse()
+        return res
+
+    def path(self, i):
+        return os.path.join(self.dirs[self.dir_ids[i]], self.names[i])
+
+    def key(self, i):
+        return (self.devs[i], self.inos[i], self.sizes[i], self.mtimes[i])
+
+    def _offer(self, table, h, i):
+        # Prefer the newest file; on ties, the one found first.
+        best = table.get(h)
+        if best is None or self.mtimes[best] < self.mtimes[i] or \
+                (self.mtimes[best] == self.mtimes[i] and i < best):
+            table[h] = i
+
+    def get_group(self, group, hasher):
+        # Built on first use.  The new group is locked before it becomes
+        # visible, so other threads wait for it to be filled in.
+        with self.lock:
+            g = self.groups.get(group)
+            if g is not None:
+                return g
+            g = self.groups[group] = DigestGroup()
+            g.lock.acquire()
+        try:
+            for i in self.candidates(group):
+                h = hasher.cache.get(self.key(i))
+                if h is None:
+                    if self.sizes[i] > 2 * PARTIAL_SIZE:
+                        g.pending.append(i)
+                        continue
+                    try:
+                        h = hasher.full(self.path(i))
+                    except OSError as e:
+                        # Vanished since the scan; leave it out
+                        print(e, file=sys.stderr)
+                        continue
+                    hasher.cache.put(self.key(i), h)
+                g.direct = True
+                self._offer(g.table, h, i)
+        finally:
+            g.lock.release()
+        return g
+
+    def resolve(self, g, partial, hasher):
+        # Fully hash the pending files whose head/tail hash is `partial`.
+        # Returns whether there were any, now or in an earlier call.
+        with g.lock:
+            if g.buckets is None:
+                g.buckets = {}
+                for i in g.pending:
+                    try:
+                        p = hasher.partial(self.path(i), self.sizes[i])
+                    except OSError as e:
+                        print(e, file=sys.stderr)
+                        continue
+                    g.buckets.setdefault(p, []).append(i)
+                g.pending = []
+            bucket = g.buckets.pop(partial, None)
+            if bucket is not None:
+                for i in bucket:
+                    try:
+                        h = hasher.full(self.path(i))
+                    except OSError as e:
+                        print(e, file=sys.stderr)
+                        continue
+                    hasher.cache.put(self.key(i), h)
+                    self._offer(g.table, h, i)
+                g.resolved.add(partial)
+            return partial in g.resolved
+
+    def nbytes(self):
+        # Approximate: containers plus the strings they own.  Names shared
+        # with the heads keys are counted once.
+        n = sum(sys.getsizeof(a) for a in (
+            self.dir_ids, self.sizes, self.mtimes, self.devs, self.inos,
+            self.next))
+        n += sum(sys.getsizeof(c) for c in (
+            self.dirs, self.names, self.heads, self.groups))
+        n += sum(sys.getsizeof(d) for d in self.dirs)
+        n += sum(sys.getsizeof(name) for name in set(self.names))
+        if not self.by_content:
+            n += sys.getsizeof((None, None)) * len(self.heads)
+        for g in self.groups.values():
+            n += sys.getsizeof(g.table)
+            n += sum(sys.getsizeof(h) for h in g.table)
+        return n
 
-def flt(files, pattern):
-    if pattern:
-        return fnmatch.filter(files, pattern)
+
+def scan_tree(top, pattern, stats, follow_symlinks=False,
+              skip_dirs=SKIP_DIRS):
+    # Yield (dirname, name, st) for every regular file under top.  All files
+    # in one directory share the same dirname object.  File types
+    # come from d_type where the filesystem provides it, and each matching
+    # file is stat'ed exactly once, relative to its directory fd.
+    try:
+        fd = os.open(top, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        yield from _scan_dir(top, fd, pattern, stats, follow_symlinks,
+                             skip_dirs)
+    finally:
+        os.close(fd)
+
+
+def _scan_dir(dirname, fd, pattern, stats, follow_symlinks, skip_dirs):
+    try:
+        stats.add('getdents')
+        with os.scandir(fd) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in skip_dirs:
+                subdirs.append(entry.name)
+        elif (not pattern or fnmatch.fnmatch(entry.name, pattern)) and \
+                entry.is_file(follow_symlinks=follow_symlinks):
+            stats.add('stat')
+            try:
+                st = entry.stat(follow_symlinks=follow_symlinks)
+            except OSError:
+                continue
+            yield dirname, entry.name, st
+
+    for name in subdirs:
+        try:
+            subfd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                            dir_fd=fd)
+        except OSError:
+            continue
+        try:
+            yield from _scan_dir(os.path.join(dirname, name), subfd, pattern,
+                                 stats, follow_symlinks, skip_dirs)
+        finally:
+            os.close(subfd)
+
+
+def init_src_index(src, pattern, stats, by_content=False):
+    index = SrcIndex(by_content)
+
+    last_dir = None
+    for dirname, fname, st in scan_tree(src, pattern, stats):
+        if dirname is not last_dir:
+            last_dir = dirname
+            dir_id = index.add_dir(dirname)
+        index.add(dir_id, fname, st)
+
+    return index
+
+
+def find_identical(index, group, path, st, hasher):
+    # Hash join of one destination file against its source group.  The
+    # destination file is only read in full if some source file could
+    # still match: one whose digest is known, or one with the same
+    # head/tail hash.  Runs in worker threads.
+    g = index.get_group(group, hasher)
+    if g.unresolved():
+        p = hasher.partial(path, st.st_size)
+        if not index.resolve(g, p, hasher) and not g.direct:
+            return None, -1
+    elif not g.table:
+        return None, -1
+
+    key = stat_key(st)
+    h = hasher.cache.get(key)
+    if h is None:
+        h = hasher.full(path)
+        hasher.cache.put(key, h)
+    return h, g.table.get(h, -1)
+
+
+def set_mtime(path, mtime_ns, key, h, hasher):
+    hasher.stats.add('utime')
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    # The content is unchanged, so the hash stays valid under the new key
+    hasher.cache.put(key[:3] + (mtime_ns,), h)
+
+
+class Output:
+    # Reports matched pairs on stdout, as text or JSON lines, and
+    # optionally records them in a plan file for --apply-plan.
+    def __init__(self, fmt='text', plan=None):
+        self.jsonl = fmt == 'jsonl'
+        self.plan = plan
+
+    def record(self, h, mtime_ns, frm, to, to_key):
+        return json.dumps({
+            'hash': binascii.hexlify(h).decode(),
+            'mtime_ns': mtime_ns,
+            'from': frm,
+            'to': to,
+            'to_size': to_key[2],
+            'to_mtime_ns': to_key[3],
+        })
+
+    def match(self, h, mtime_ns, frm, to, to_key):
+        if self.jsonl:
+            print(self.record(h, mtime_ns, frm, to, to_key))
+        else:
+            print('{h} {mtime:%Y-%m-%d %H:%M:%S.%f} {frm} => {to}'.format(
+                  frm=frm,
+                  to=to,
+                  mtime=datetime.fromtimestamp(mtime_ns / 1.e9),
+                  h=binascii.hexlify(h).decode()))
+        if self.plan:
+            # Absolute, as the plan is often applied from somewhere else
+            self.plan.write(self.record(
+                h, mtime_ns, os.path.abspath(frm), os.path.abspath(to),
+                to_key) + '\n')
+
+
+def apply(index, dst_path, dst_key, future, output, pretend, bidirectional,
+          hasher):
+    # A file that vanishes or turns unreadable only costs its own match
+    try:
+        h, i = future.result()
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return
+    if i < 0:
+        return
+    src_path = index.path(i)
+    src_mtime_ns = index.mtimes[i]
+    dst_mtime_ns = dst_key[3]
+    reverse = bidirectional and dst_mtime_ns > src_mtime_ns
+    if reverse:
+        output.match(h, dst_mtime_ns, dst_path, src_path, index.key(i))
     else:
-        return files
+        output.match(h, src_mtime_ns, src_path, dst_path, dst_key)
+    if pretend:
+        return
+    try:
+        if reverse:
+            set_mtime(src_path, dst_mtime_ns, index.key(i), h, hasher)
+            index.mtimes[i] = dst_mtime_ns
+        else:
+            set_mtime(dst_path, src_mtime_ns, dst_key, h, hasher)
+    except OSError as e:
+        print(e, file=sys.stderr)
 
 
-def init_src_dic(src, pattern):
-    dic = {}
+def scan_dst(dst, pattern, stats):
+    # Like the original os.fwalk() version, symlinks to regular files are
+    # followed and VCS directories are not skipped on the destination side.
+    return scan_tree(dst, pattern, stats, follow_symlinks=True, skip_dirs=())
 
-    for dirname, subdirs, subfiles, dirfd in os.fwalk(src):
-        for skip in SKIP_DIRS:
-            if skip in subdirs:
-                subdirs.remove(skip)
-        for fname in flt(subfiles, pattern):
-            st = os.stat(fname, dir_fd=dirfd, follow_symlinks=False)
-            if stat.S_ISREG(st.st_mode):
-                fullname = os.path.join(dirname, fname)
-                dic.setdefault(fname, []).append(fullname)
 
-    return dic
+def copy(index, dst_files, output, pretend, hasher, jobs=1,
+         bidirectional=False):
+    # Hashing runs in a thread pool while we keep walking.  Results are
+    # applied in walk order, with at most jobs * 4 files in flight.
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for dirname, fname, st in dst_files:
+            group = index.group(fname, st.st_size)
+            if group not in index.heads:
+                continue
+
+            dst_path = os.path.join(dirname, fname)
+            pending.append((dst_path, stat_key(st), pool.submit(
+                find_identical, index, group, dst_path, st, hasher)))
+            if len(pending) >= jobs * 4:
+                apply(index, *pending.popleft(), output, pretend,
+                      bidirectional, hasher)
+
+        while pending:
+            apply(index, *pending.popleft(), output, pretend, bidirectional,
+                  hasher)
+
 
+def apply_plan(plan, output, pretend, hasher):
+    # Replay a plan written by --plan, after its header line.  Nothing is
+    # rehashed; a target is skipped if its size or mtime changed since the
+    # plan was made.  Bad records and failures are reported, and the rest
+    # of the plan still applied.
+    for lineno, line in enumerate(plan, 2):
+        try:
+            rec = json.loads(line)
+            to = rec['to']
+            mtime_ns = rec['mtime_ns']
+            frm = rec['from']
+            size = rec['to_size']
+            old_mtime_ns = rec['to_mtime_ns']
+            h = binascii.unhexlify(rec['hash'])
+        except KeyError as e:
+            print('Skipping line {}: no {} in record'.format(lineno, e),
+                  file=sys.stderr)
+            continue
+        except (ValueError, TypeError, binascii.Error) as e:
+            print('Skipping line {}: bad record ({})'.format(lineno, e),
+                  file=sys.stderr)
+            continue
+        try:
+            st = os.stat(to)
+        except OSError as e:
+            print('Skipping {}: {}'.format(to, e), file=sys.stderr)
+            continue
+        if st.st_size != size or st.st_mtime_ns != old_mtime_ns:
+            print('Skipping {}: changed since the plan was made'.format(to),
+                  file=sys.stderr)
+            continue
+        output.match(h, mtime_ns, frm, to, stat_key(st))
+        if pretend:
+            continue
+        try:
+            set_mtime(to, mtime_ns, stat_key(st), h, hasher)
+        except OSError as e:
+            print('Failed to set mtime of {}: {}'.format(to, e),
+                  file=sys.stderr)
 
-def hash_file(path, dir_fd=None):
-    def opener(name, flags):
-        return os.open(name, flags, dir_fd=dir_fd)
 
-    with open(path, 'rb', opener=opener) as f:
-        content = f.read()
-    return hashlib.md5(content).digest()
+class Inotify:
+    # Minimal inotify(7) binding through ctypes.
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
 
+    EVENT = struct.Struct('iIII')
 
-def hash_files(filename_list):
-    if not isinstance(filename_list, list):
-        return filename_list
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wds = {}
 
-    res = {}
-    for path in filename_list:
-        h = hash_file(path)
-        mtime_ns = os.stat(path).st_mtime_ns
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path),
+            mask | self.IN_ONLYDIR | self.IN_DONT_FOLLOW)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.wds[wd] = path
 
-        if h not in res or res[h].mtime_ns < mtime_ns:
-            res[h] = File(path=path, mtime_ns=mtime_ns)
+    def read(self, timeout):
+        # Return a list of (dirname, name, mask), or [] on timeout.
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = self.EVENT.unpack_from(buf, pos)
+            pos += self.EVENT.size
+            name = os.fsdecode(buf[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & self.IN_IGNORED:
+                self.wds.pop(wd, None)
+            elif mask & self.IN_Q_OVERFLOW:
+                events.append((None, None, mask))
+            elif wd in self.wds:
+                events.append((self.wds[wd], name, mask))
+        return events
 
-    return res
+    def close(self):
+        os.close(self.fd)
 
 
-def copy(src_dic, dst, pattern, pretend):
-    for dirname, subdirs, subfiles, dirfd in os.fwalk(dst):
-        for fname in flt(subfiles, pattern):
-            src_info = src_dic.get(fname)
-            if not src_info:
+class Watcher:
+    # Incremental resync after the initial full pass: watch every directory
+    # of both trees, collect events until things have been quiet for
+    # COALESCE seconds (so a "git checkout" is handled as one batch), then
+    # rehash only what changed.  Anything we can't track incrementally
+    # (queue overflow, a directory moved away) triggers a full rescan.
+    COALESCE = 0.5
+    MAX_BATCH = 10
+
+    SRC_MASK = (Inotify.IN_CLOSE_WRITE | Inotify.IN_ATTRIB |
+                Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO |
+                Inotify.IN_CREATE | Inotify.IN_DELETE)
+    # No IN_ATTRIB here, or our own utime() calls would feed back.
+    DST_MASK = (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_FROM |
+                Inotify.IN_MOVED_TO | Inotify.IN_CREATE | Inotify.IN_DELETE)
+
+    def __init__(self, src, dst, pattern, output, pretend, hasher, jobs,
+                 by_content=False, bidirectional=False):
+        self.src = src
+        self.dst = dst
+        self.pattern = pattern
+        self.output = output
+        self.pretend = pretend
+        self.hasher = hasher
+        self.jobs = jobs
+        self.by_content = by_content
+        self.bidirectional = bidirectional
+        self.dst_groups = collections.defaultdict(set)  # group -> paths
+        self.dst_paths = {}  # path -> group
+        self.inotify = None
+        self.watch_trees()
+
+    def watch_trees(self):
+        # Called before the trees are scanned, so nothing that changes
+        # during the scan is missed.
+        if self.inotify is not None:
+            self.inotify.close()
+        self.inotify = Inotify()
+        self.add_tree(self.src, self.SRC_MASK, SKIP_DIRS)
+        self.add_tree(self.dst, self.DST_MASK, ())
+
+    def use_index(self, index):
+        self.index = index
+        self.dir_ids = {d: i for i, d in enumerate(index.dirs)}
+        self.src_paths = {index.path(i): i for i in range(len(index))}
+        self.dst_groups.clear()
+        self.dst_paths.clear()
+
+    def rescan(self):
+        print('Rescanning both trees', file=sys.stderr)
+        self.watch_trees()
+        self.use_index(init_src_index(self.src, self.pattern,
+                                      self.hasher.stats, self.by_content))
+        self.resync(self.record_dst(
+            scan_dst(self.dst, self.pattern, self.hasher.stats)))
+
+    def record_dst(self, dst_files):
+        # Pass-through for copy() so we know which dst files belong to
+        # which source group.
+        for dirname, fname, st in dst_files:
+            path = os.path.join(dirname, fname)
+            group = self.index.group(fname, st.st_size)
+            old = self.dst_paths.get(path)
+            if old != group:
+                if old is not None:
+                    self.dst_groups[old].discard(path)
+                if group is None:
+                    del self.dst_paths[path]
+                else:
+                    self.dst_paths[path] = group
+                    self.dst_groups[group].add(path)
+            yield dirname, fname, st
+
+    def add_tree(self, top, mask, skip_dirs):
+        # A directory may be gone again by the time we get to it, which is
+        # fine.  Anything else (typically running out of watches) leaves
+        # that directory unwatched, so say so and carry on.
+        for dirname, subdirs, files in os.walk(top):
+            subdirs[:] = [d for d in subdirs if d not in skip_dirs]
+            try:
+                self.inotify.add_watch(dirname, mask)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                if e.errno == errno.ENOSPC:
+                    print('Not watching {}: out of inotify watches (see '
+                          'fs.inotify.max_user_watches)'.format(dirname),
+                          file=sys.stderr)
+                else:
+                    print('Not watching {}: {}'.format(dirname, e),
+                          file=sys.stderr)
+
+    def in_src(self, dirname):
+        return dirname == self.src or \
+            dirname.startswith(os.path.join(self.src, ''))
+
+    def matches(self, name):
+        return not self.pattern or fnmatch.fnmatch(name, self.pattern)
+
+    def collect(self):
+        events = self.inotify.read(None)
+        deadline = time.monotonic() + self.MAX_BATCH
+        while time.monotonic() < deadline:
+            more = self.inotify.read(self.COALESCE)
+            if not more:
+                break
+            events += more
+        return events
+
+    def run(self):
+        while True:
+            events = self.collect()
+            if any(dirname is None or
+                   mask & Inotify.IN_ISDIR and mask & Inotify.IN_MOVED_FROM
+                   for dirname, name, mask in events):
+                self.rescan()
                 continue
-            if not isinstance(src_info, dict):
-                src_info = src_dic[fname] = hash_files(src_info)
 
-            st = os.stat(fname, dir_fd=dirfd)
-            if not stat.S_ISREG(st.st_mode):
+            src_changed = set()
+            dst_changed = set()
+            for dirname, name, mask in events:
+                in_src = self.in_src(dirname)
+                path = os.path.join(dirname, name)
+                if mask & Inotify.IN_ISDIR:
+                    if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                        self.new_dir(path, in_src, src_changed, dst_changed)
+                    continue
+                if self.matches(name):
+                    (src_changed if in_src else dst_changed).add(path)
+
+            for group in self.update_src(src_changed):
+                dst_changed.update(self.dst_groups.get(group, ()))
+            for path in dst_changed:
+                if not os.path.isfile(path):
+                    group = self.dst_paths.pop(path, None)
+                    if group is not None:
+                        self.dst_groups[group].discard(path)
+            self.resync(self.record_dst(self.stat_dst(sorted(dst_changed))))
+
+    def new_dir(self, path, in_src, src_changed, dst_changed):
+        if in_src:
+            if os.path.basename(path) in SKIP_DIRS:
+                return
+            mask, changed, skip_dirs = self.SRC_MASK, src_changed, SKIP_DIRS
+        else:
+            mask, changed, skip_dirs = self.DST_MASK, dst_changed, ()
+        self.add_tree(path, mask, skip_dirs)
+        for dirname, subdirs, files in os.walk(path):
+            subdirs[:] = [d for d in subdirs if d not in skip_dirs]
+            changed.update(os.path.join(dirname, f)
+                           for f in files if self.matches(f))
+
+    def update_src(self, paths):
+        # Retire stale index entries and add current ones.  Returns the set
+        # of groups that gained a file.
+        index = self.index
+        groups = set()
+        for path in paths:
+            dirname, name = os.path.split(path)
+            old = self.src_paths.pop(path, None)
+            if old is not None:
+                index.retire(old)
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue
+            group = index.group(name, st.st_size)
+            if group is None or not stat.S_ISREG(st.st_mode):
                 continue
+            dir_id = self.dir_ids.get(dirname)
+            if dir_id is None:
+                dir_id = self.dir_ids[dirname] = index.add_dir(dirname)
+            self.src_paths[path] = len(index)
+            index.add(dir_id, name, st)
+            groups.add(group)
+        return groups
 
-            h = hash_file(fname, dir_fd=dirfd)
+    def stat_dst(self, paths):
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                dirname, name = os.path.split(path)
+                yield dirname, name, st
 
-            src_file = src_info.get(h)
-            if src_file:
-                dst_path = os.path.join(dirname, fname)
-                src_mtime_ns = src_file.mtime_ns
-                print('{h} {mtime:%Y-%m-%d %H:%M:%S.%f} {src} => {dst}'.format(
-                      src=src_file.path,
-                      dst=dst_path,
-                      mtime=datetime.fromtimestamp(src_mtime_ns / 1.e9),
-                      h=binascii.hexlify(h).decode()))
-                if not pretend:
-                    os.utime(fname, dir_fd=dirfd,
-                             ns=(src_mtime_ns, src_mtime_ns))
+    def resync(self, dst_files):
+        # Files may vanish under us at any time; copy() skips them one by
+        # one, and the next batch of events will sort things out.
+        copy(self.index, dst_files, self.output, self.pretend,
+             self.hasher, self.jobs, self.bidirectional)
+        self.hasher.cache.flush()
+        sys.stdout.flush()
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Copy file mtime by identicality')
-    parser.add_argument('src', type=str, help='Source dir')
-    parser.add_argument('dst', type=str, help='Destination dir')
+    parser.add_argument('src', type=str, nargs='?', help='Source dir')
+    parser.add_argument('dst', type=str, nargs='?', help='Destination dir')
     parser.add_argument('-p', '--pattern', help='Pattern (e.g. *.h)')
     parser.add_argument('-P', '--pretend', action='store_true',
                         help='Don\'t actually copy mtime')
+    parser.add_argument('-m', '--match', default='name',
+                        choices=['name', 'content'],
+                        help='Pair files by basename and content, or by '
+                             'content alone, so renamed files match too; '
+                             'empty files are skipped then, as they would '
+                             'all match each other (default: %(default)s)')
+    parser.add_argument('-b', '--bidirectional', action='store_true',
+                        help='Apply the newer mtime of each pair to both '
+                             'sides, instead of always copying src to dst')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of hashing threads '
+                             '(default: %(default)s)')
+    parser.add_argument('-d', '--digest', default='md5',
+                        choices=sorted(DIGESTS),
+                        help='Content digest (default: %(default)s)')
+    parser.add_argument('--cache', default=default_cache_path(),
+                        help='Hash cache file (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Don\'t use the hash cache')
+    parser.add_argument('-f', '--format', default='text',
+                        choices=['text', 'jsonl'],
+                        help='Output format (default: %(default)s)')
+    parser.add_argument('--plan', metavar='FILE',
+                        help='Write matches to a plan file for --apply-plan '
+                             'instead of applying them (implies --pretend)')
+    parser.add_argument('--apply-plan', metavar='FILE',
+                        help='Apply a plan file written by --plan, without '
+                             'scanning or hashing, and exit')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='After the initial pass, keep watching both '
+                             'trees with inotify and resync changed files')
+    parser.add_argument('--stats', action='store_true',
+                        help='Report syscalls, bytes read and time per phase')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='Report source index size and peak RSS')
+    parser.add_argument('--evict-cache', type=float, metavar='DAYS',
+                        help='Remove cache entries unused for DAYS days, '
+                             'compact the cache and exit')
     args = parser.parse_args()
 
-    src_dic = init_src_dic(args.src, args.pattern)
+    if args.evict_cache is not None:
+        cache = HashCache(args.cache)
+        if cache.db is None:
+            sys.exit(1)
+        try:
+            n = cache.evict(args.evict_cache)
+        except sqlite3.Error as e:
+            sys.exit('Failed to evict from {}: {}'.format(args.cache, e))
+        finally:
+            cache.close()
+        print('Evicted {} entries from {}'.format(n, args.cache))
+        return
+
+    if args.apply_plan:
+        with open(args.apply_plan) as plan:
+            try:
+                header = json.loads(plan.readline())
+            except ValueError:
+                header = None
+            if not isinstance(header, dict) or header.get('plan') != 1 or \
+                    header.get('digest') not in DIGESTS:
+                parser.error('{} is not a plan written by --plan'.format(
+                    args.apply_plan))
+            cache = NullCache() if args.no_cache else \
+                HashCache(args.cache, header['digest'])
+            try:
+                apply_plan(plan, Output(args.format), args.pretend,
+                           Hasher(header['digest'], cache))
+            finally:
+                cache.close()
+        return
+
+    if not args.src or not args.dst:
+        parser.error('src and dst are required')
+    if args.plan and args.watch:
+        parser.error('--plan and --watch are mutually exclusive')
+
+    plan = None
+    if args.plan:
+        args.pretend = True
+        plan = open(args.plan, 'w')
+        plan.write(json.dumps({'plan': 1, 'digest': args.digest}) + '\n')
+    output = Output(args.format, plan)
+
+    cache = NullCache() if args.no_cache else \
+        HashCache(args.cache, args.digest)
+    stats = Stats()
+    hasher = Hasher(args.digest, cache, stats)
+    jobs = max(args.jobs, 1)
+    by_content = args.match == 'content'
+    try:
+        if args.watch:
+            watcher = Watcher(args.src, args.dst, args.pattern, output,
+                              args.pretend, hasher, jobs, by_content,
+                              args.bidirectional)
+
+        with stats.phase('index'):
+            index = init_src_index(args.src, args.pattern, stats, by_content)
+
+        dst_files = scan_dst(args.dst, args.pattern, stats)
+        if args.watch:
+            watcher.use_index(index)
+            dst_files = watcher.record_dst(dst_files)
+
+        with stats.phase('match'):
+            copy(index, dst_files, output, args.pretend, hasher, jobs,
+                 args.bidirectional)
+
+        if args.watch:
+            sys.stdout.flush()
+            watcher.run()
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+    finally:
+        if plan:
+            plan.close()
+        cache.close()
+        if not args.no_cache:
+            print('Hash cache: {} hits, {} misses'.format(
+                cache.hits, cache.misses), file=sys.stderr)
+        if args.stats:
+            stats.report()
 
-    copy(src_dic, args.dst, args.pattern, args.pretend)
+    if args.memory_report:
+        print('Source index: {} files, {} dirs, ~{} bytes'.format(
+            len(index), len(index.dirs), index.nbytes()), file=sys.stderr)
+        print('Peak RSS: {} KiB'.format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+            file=sys.stderr)
 
 
 if __name__ == '__main__':
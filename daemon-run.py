@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding: utf-8
 
 #
@@ -32,156 +32,16 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
-from __future__ import print_function
-
+import json
 import os
-import pprint
-import pwd
 import socket
 import stat
 import sys
-import subprocess
-import threading
 import time
 
-try:
-    import Queue as queue
-except ImportError:
-    import queue
-
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
-try:
-    FileNotFoundError
-except NameError:
-    FileNotFoundError = OSError
-
-
-def get_socket_path():
-    path = '/tmp/daemon-run-{}'.format(pwd.getpwuid(os.getuid()).pw_name)
-    if sys.platform.startswith('linux'):
-        path = '\0' + path
-    return path
-
-
-def colorize(*args, **kwargs):
-    color = kwargs.pop('color')
-    print('[{}] \033[{}m'.format(time.strftime('%Y-%m-%d %H:%M:%S'), color),
-          end='')
-    kwargs['end'] = '\033[0m' + kwargs.pop('end', '\n')
-    print(*args, **kwargs)
-
-
-def info(*args, **kwargs):
-    colorize(*args, color='32', **kwargs)
-
-
-def error(*args, **kwargs):
-    colorize(*args, color='31;1', **kwargs)
-
-
-current_proc = None
-
-
-def executor(q):
-    global current_proc
-    while True:
-        req = q.get()
-        if req is None:
-            break
-        info('Handling request: {}'.format(pprint.pformat(req)))
-        env = os.environ.copy()
-        new_env = req.get('environ')
-        new_env['PWD'] = req['pwd']
-        if new_env:
-            env.update(new_env)
-        try:
-            current_proc = subprocess.Popen(req['cmd'], cwd=req['pwd'], env=env)
-            ret = current_proc.wait()
-        except (KeyError, TypeError, ValueError, OSError) as e:
-            error('Failed to execute command {}: {}'.format(
-                pprint.pformat(req), str(e)))
-        else:
-            info('Done with request: {} ret code: {}'.format(
-                pprint.pformat(req), ret), end='\n'*5)
-        finally:
-            current_proc = None
-
-
-def daemon_handle(q, conn):
-    try:
-        conn.settimeout(2)
-        req_s = conn.recv(16384, socket.MSG_WAITALL)
-        info('Received {} bytes'.format(len(req_s)))
-
-        try:
-            req = pickle.loads(req_s)
-        except (pickle.UnpicklingError, ValueError, TypeError) as e:
-            error(str(e))
-            conn.send(b'Failed to unpickle message')
-            return
-
-        conn.send(b'OK')
-
-    except socket.error as e:
-        error(str(e))
-        return
-    finally:
-        conn.close()
-
-    info('Parsed request: {}'.format(pprint.pformat(req)))
-
-    cmd = req.get('cmd', ())
-    if cmd and cmd[0] == '--kill':
-        proc = current_proc
-        if proc:
-            for i in range(20):
-                if proc.poll() is not None:
-                    break
-                else:
-                    proc.terminate()
-                    info('Sent SIGTERM to current process')
-                    time.sleep(0.1)
-            else:
-                proc.kill()
-                info('Sent SIGKILL to current process')
-        else:
-            error('No current process to kill')
-    else:
-        q.put(req)
-
-
-def daemon():
-    path = get_socket_path()
-    if not path.startswith('\0'):
-        try:
-            os.unlink(path)
-        except FileNotFoundError:
-            pass
-    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(path)
-    s.listen(5)
-    info('Listing on Unix-domain socket', s.getsockname())
-
-    q = queue.Queue()
-    th = threading.Thread(target=executor, args=(q,))
-    th.start()
-
-    try:
-        while True:
-            conn, addr = s.accept()
-            info('Accepted new connection', addr)
-            daemon_handle(q, conn)
-    except KeyboardInterrupt:
-        import signal
-        sys.exit(128 + signal.SIGINT)
-    finally:
-        q.put(None)
-        th.join()
+from daemon_run_common import (
+    FRAME_HEADER, MAGIC, decode_frame_header, encode_frame, error,
+    get_socket_path, info, parse_ionice, parse_size)
 
 
 def get_cwd():
@@ -216,8 +76,183 @@ def select_environ():
 
 
 def usage():
-    print('{}: Starts a daemon'.format(sys.argv[0]))
-    print('{} [-C <WORKING_DIRECTORY>] CMD [ARGS...]'.format(sys.argv[0]))
+    print('{} [-j JOBS] [-Q NAME=LIMIT...]: Starts a daemon'.format(
+        sys.argv[0]))
+    print('{} [-C <WORKING_DIRECTORY>] [-q QUEUE] [-p PRIORITY] [-f] [-r] '
+          '[-n NICE] [--ionice CLASS[:LEVEL]] [--mem SIZE] [--cpu SECONDS] '
+          'CMD [ARGS...]'.format(sys.argv[0]))
+    print('{} --attach JOB_ID'.format(sys.argv[0]))
+    print('{} --kill [all|JOB_ID...]'.format(sys.argv[0]))
+    print('{} --history [N]'.format(sys.argv[0]))
+    print('{} --stats'.format(sys.argv[0]))
+    print('{} --benchmark-client [N]'.format(sys.argv[0]))
+    print()
+    print('-f, --follow: Show the output of the command, and exit with its '
+          'exit status')
+    print('-r, --restart: Kill running jobs identical to this one first')
+    print('-n, --nice, --ionice, --mem, --cpu: Nice level, I/O scheduling, '
+          'address space (RLIMIT_AS) and CPU time (RLIMIT_CPU) limits, '
+          'overriding the daemon\'s --default-* options')
+    print('--attach: Show the recent and further output of a job')
+    print('--history: Show the last N (default 20) finished jobs')
+    print('--stats: Show resource usage of finished jobs, by command')
+    print('--benchmark-client: Measure how fast requests can be submitted')
+    print()
+    print('MAXRSS in --history and --stats includes the copy of the daemon '
+          'that a job is forked as, and is marked with * when it isn\'t '
+          'above that')
+
+
+def recv_exact(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1024 * 1024))
+        if not chunk:
+            raise EOFError('Connection closed by daemon')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    n = decode_frame_header(recv_exact(sock, FRAME_HEADER.size))
+    return json.loads(recv_exact(sock, n).decode('utf-8'))
+
+
+def follow_output(s):
+    # Copy a job's output to ours until it exits.  Returns our exit status.
+    resp = recv_frame(s)
+    if resp.get('status') != 'ok':
+        error(resp.get('message'), file=sys.stderr)
+        return 1
+    info('Following job {}'.format(resp['job']), file=sys.stderr)
+    outputs = {1: sys.stdout.buffer, 2: sys.stderr.buffer}
+    while True:
+        resp = recv_frame(s)
+        status = resp.get('status')
+        if status == 'output':
+            out = outputs.get(resp['fd'], sys.stderr.buffer)
+            out.write(recv_exact(s, resp['size']))
+            out.flush()
+        elif status == 'exit':
+            ret = resp['returncode']
+            return 128 - ret if ret < 0 else ret
+        else:
+            error(resp.get('message'), file=sys.stderr)
+            return 1
+
+
+def format_cmd(cmd, width=60):
+    import shlex
+    s = shlex.join(cmd)
+    return s if len(s) <= width else s[:width - 3] + '...'
+
+
+def rss_is_daemons(r):
+    # A job's maxrss includes the copy of the daemon it was forked as, so
+    # one that isn't above the daemon's RSS at the time says nothing about
+    # the command itself
+    forkrss = r.get('forkrss')
+    return forkrss is not None and r['maxrss'] <= forkrss
+
+
+def format_rss(maxrss, flagged):
+    return '{}Ki{}'.format(maxrss, '*' if flagged else '')
+
+
+RSS_NOTE = ('* MAXRSS is no more than the daemon\'s own RSS when the job '
+            'was forked;\n  the command itself may have used much less')
+
+
+def show_history(records, n):
+    print('{:>6} {:19} {:>9} {:>9} {:>9} {:>10} {:>4}  {}'.format(
+        'JOB', 'START', 'WALL', 'USER', 'SYS', 'MAXRSS', 'RET', 'COMMAND'))
+    row = '{:>6} {:19} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>4}  {}'
+    flagged = False
+    for r in records[-n:]:
+        flag = rss_is_daemons(r)
+        flagged |= flag
+        print(row.format(
+            r['job'],
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['start'])),
+            r['wall'], r['user'], r['sys'], format_rss(r['maxrss'], flag),
+            r['ret'], format_cmd(r['cmd'])))
+    if flagged:
+        print(RSS_NOTE)
+
+
+def show_stats(records):
+    # Totals by command line, heaviest first
+    totals = {}
+    for r in records:
+        t = totals.setdefault(tuple(r['cmd']), [0, 0., 0., 0, False, 0])
+        t[0] += 1
+        t[1] += r['wall']
+        t[2] += r['user'] + r['sys']
+        if r['maxrss'] >= t[3]:
+            t[3] = r['maxrss']
+            t[4] = rss_is_daemons(r)
+        t[5] += r['ret'] != 0
+    print('{:>6} {:>10} {:>10} {:>10} {:>6}  {}'.format(
+        'RUNS', 'WALL', 'CPU', 'MAXRSS', 'FAILED', 'COMMAND'))
+    flagged = False
+    for cmd, (runs, wall, cpu, maxrss, flag, failed) in sorted(
+            totals.items(), key=lambda item: -item[1][1]):
+        flagged |= flag
+        print('{:>6} {:>10.2f} {:>10.2f} {:>10} {:>6}  {}'.format(
+            runs, wall, cpu, format_rss(maxrss, flag), failed,
+            format_cmd(list(cmd))))
+    if flagged:
+        print(RSS_NOTE)
+
+
+def connect():
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(get_socket_path())
+    return s
+
+
+def benchmark_client(n):
+    # Submission rates against a running daemon.  Submits `true` in the
+    # 'benchmark' queue; most of them are coalesced.
+    msg = {
+        'pwd': get_cwd(),
+        'cmd': ['true'],
+        'environ': select_environ(),
+        'queue': 'benchmark',
+    }
+
+    def report(what, count, seconds):
+        print('{:<28} {:6} in {:7.3f} s: {:9.1f}/s'.format(
+            what, count, seconds, count / seconds))
+
+    start = time.monotonic()
+    for i in range(n):
+        s = connect()
+        s.sendall(MAGIC + encode_frame(msg))
+        s.shutdown(socket.SHUT_WR)
+        recv_frame(s)
+        s.close()
+    report('Connection per request', n, time.monotonic() - start)
+
+    s = connect()
+    s.sendall(MAGIC)
+    start = time.monotonic()
+    for i in range(n):
+        s.sendall(encode_frame(msg))
+        recv_frame(s)
+    report('One connection', n, time.monotonic() - start)
+    s.close()
+
+    # Includes interpreter startup, as when run from a shell
+    import subprocess
+    m = max(n // 20, 1)
+    argv = [sys.executable, os.path.abspath(__file__), '-q', 'benchmark',
+            'true']
+    start = time.monotonic()
+    for i in range(m):
+        subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+    report('Client process per request', m, time.monotonic() - start)
 
 
 def client():
@@ -226,36 +261,94 @@ def client():
         return
 
     pwd = None
+    queue_name = None
+    priority = 0
+    follow = False
+    restart = False
+    limits = {}
 
     args = sys.argv[1:]
     while args:
         if args[0] == '-C' and len(args) >= 2:
             pwd = os.path.realpath(args[1])
             del args[:2]
+        elif args[0] == '-q' and len(args) >= 2:
+            queue_name = args[1]
+            del args[:2]
+        elif args[0] == '-p' and len(args) >= 2:
+            priority = int(args[1])
+            del args[:2]
+        elif args[0] in ('-f', '--follow'):
+            follow = True
+            del args[:1]
+        elif args[0] in ('-r', '--restart'):
+            restart = True
+            del args[:1]
+        elif args[0] in ('-n', '--nice') and len(args) >= 2:
+            limits['nice'] = int(args[1])
+            del args[:2]
+        elif args[0] == '--ionice' and len(args) >= 2:
+            parse_ionice(args[1])
+            limits['ionice'] = args[1]
+            del args[:2]
+        elif args[0] == '--mem' and len(args) >= 2:
+            limits['mem'] = parse_size(args[1])
+            del args[:2]
+        elif args[0] == '--cpu' and len(args) >= 2:
+            limits['cpu'] = int(args[1])
+            del args[:2]
         else:
             break
 
-    path = get_socket_path()
-    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    s.connect(path)
+    if args[:1] == ['--attach']:
+        follow = True
+    elif args[:1] == ['--benchmark-client']:
+        benchmark_client(int(args[1]) if args[1:] else 1000)
+        return
+
+    s = connect()
     msg = {
         'pwd': pwd or get_cwd(),
         'cmd': args,
         'environ': select_environ(),
+        'queue': queue_name,
+        'priority': priority,
+        'follow': follow,
+        'restart': restart,
     }
-    info(pprint.pformat(msg))
-    # Force version 2 so that Python 2 and 3 can be used interchagably
-    s.send(pickle.dumps(msg, 2))
+    msg.update(limits)
+    # Keep stdout for the command's own output when following
+    info(json.dumps(msg, indent=1, sort_keys=True),
+         file=sys.stderr if follow else sys.stdout)
+    s.sendall(MAGIC + encode_frame(msg))
     s.shutdown(socket.SHUT_WR)
-    info('RECEIVED FROM DAEMON:', s.recv(4096))
+    if follow:
+        sys.exit(follow_output(s))
+    if args[:1] in (['--history'], ['--stats']):
+        resp = recv_frame(s)
+        if args[0] == '--stats':
+            show_stats(resp['history'])
+        else:
+            show_history(resp['history'], int(args[1]) if args[1:] else 20)
+        return
+    info('RECEIVED FROM DAEMON:', recv_frame(s))
+
+
+DAEMON_OPTIONS = ('-j', '--jobs', '-Q', '--queue', '--default-nice',
+                  '--default-ionice', '--default-mem', '--default-cpu',
+                  '--cgroup', '--no-coalesce', '--history-file',
+                  '--history-size', '--journal', '--legacy-pickle')
 
 
 def main():
-    if len(sys.argv) < 2:
-        daemon()
+    if len(sys.argv) < 2 or sys.argv[1].split('=')[0] in DAEMON_OPTIONS:
+        # Only the daemon needs asyncio, subprocess etc.
+        import daemon_run_server
+        daemon_run_server.daemon(sys.argv[1:])
     else:
         client()
 
 
 if __name__ == '__main__':
     main()
+
@@ -0,0 +1,116 @@
+# coding: utf-8
+
+#
+# Copyright (c) 2019-2021, chys <admin@CHYS.INFO>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+#   Neither the name of chys <admin@CHYS.INFO> nor the names of other
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Parts of daemon-run.py shared by the client and the daemon
+# (daemon_run_server.py).  Keep the imports here cheap: the client runs once
+# per submitted command.
+
+import json
+import os
+import pwd
+import struct
+import sys
+import time
+
+
+def get_socket_path():
+    path = '/tmp/daemon-run-{}'.format(pwd.getpwuid(os.getuid()).pw_name)
+    if sys.platform.startswith('linux'):
+        path = '\0' + path
+    return path
+
+
+def colorize(*args, **kwargs):
+    color = kwargs.pop('color')
+    print('[{}] \033[{}m'.format(time.strftime('%Y-%m-%d %H:%M:%S'), color),
+          end='', file=kwargs.get('file'))
+    kwargs['end'] = '\033[0m' + kwargs.pop('end', '\n')
+    print(*args, **kwargs)
+
+
+def info(*args, **kwargs):
+    colorize(*args, color='32', **kwargs)
+
+
+def error(*args, **kwargs):
+    colorize(*args, color='31;1', **kwargs)
+
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(s):
+    # '512M' -> 536870912
+    s = str(s).strip().upper().rstrip('B')
+    if s[-1:] in SIZE_SUFFIXES:
+        return int(float(s[:-1]) * SIZE_SUFFIXES[s[-1]])
+    return int(s)
+
+
+IOPRIO_CLASSES = {'realtime': 1, 'rt': 1, 'best-effort': 2, 'be': 2,
+                  'idle': 3}
+
+
+def parse_ionice(s):
+    # 'CLASS[:LEVEL]' -> (class, level), as for ionice(1)
+    name, _, level = str(s).partition(':')
+    cls = IOPRIO_CLASSES.get(name)
+    if cls is None:
+        cls = int(name)
+        if not 1 <= cls <= 3:
+            raise ValueError('Invalid ionice class: {}'.format(name))
+    level = int(level) if level else (0 if cls == 3 else 4)
+    if not 0 <= level <= 7:
+        raise ValueError('Invalid ionice level: {}'.format(level))
+    return cls, level
+
+
+# Wire protocol: a connection starts with MAGIC, which includes the
+# protocol version, followed by any number of request frames.  Each frame
+# is a 4-byte big-endian length and a UTF-8 JSON object.  Each request
+# gets one or more response frames.
+MAGIC = b'DRN\x01'
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME = 256 * 1024 * 1024
+
+
+def encode_frame(obj):
+    data = json.dumps(obj).encode('utf-8')
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def decode_frame_header(header):
+    n, = FRAME_HEADER.unpack(header)
+    if n > MAX_FRAME:
+        raise ValueError('Frame too large: {} bytes'.format(n))
+    return n
@@ -0,0 +1,1010 @@
+# coding: utf-8
+
+#
+# Copyright (c) 2019-2021, chys <admin@CHYS.INFO>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+#   Neither the name of chys <admin@CHYS.INFO> nor the names of other
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# The daemon of daemon-run.py.  It's a module rather than part of the script
+# so that it's byte-compiled once instead of on every run of the client.
+
+import argparse
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import json
+import os
+import pickle
+import pprint
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from daemon_run_common import (
+    FRAME_HEADER, MAGIC, decode_frame_header, encode_frame, error,
+    get_socket_path, info, parse_ionice, parse_size)
+
+
+# Output of each job is kept in a ring buffer of about RING_SIZE bytes, so
+# that a client attaching later sees the recent part.  A following client
+# that falls more than MAX_BACKLOG bytes behind is dropped.
+RING_SIZE = 1024 * 1024
+MAX_BACKLOG = 4 * 1024 * 1024
+READ_SIZE = 64 * 1024
+# Seconds to keep reading a job's output after it exits
+PIPE_GRACE = 1
+# Finished jobs remembered for --attach
+KEEP_FINISHED = 100
+# Seconds of CPU time between SIGXCPU at a job's CPU limit and SIGKILL
+CPU_GRACE = 5
+
+# Running processes (subprocess.Popen), by job ID.  Signal them with
+# os.kill(): Popen.send_signal() may reap the child behind wait_child().
+running_procs = {}
+# Pending, running and recently finished jobs, by job ID
+jobs = {}
+finished_jobs = collections.deque()
+job_ids = itertools.count(1)
+
+
+class Follower:
+    # Output queued for one following client
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.backlog = 0
+
+    def put_nowait(self, item):
+        self.queue.put_nowait(item)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+# What makes two requests the same work: where and how it runs, and
+# with what limits
+KEY_FIELDS = ('pwd', 'cmd', 'environ', 'queue', 'nice', 'ionice', 'mem',
+              'cpu')
+
+
+def request_key(req):
+    # Requests with the same key are the same work
+    return json.dumps([req.get(name) for name in KEY_FIELDS],
+                      sort_keys=True)
+
+
+class Job:
+    def __init__(self, job_id, req):
+        self.id = job_id
+        self.req = req
+        self.key = request_key(req)
+        self.cgroup = None
+        self.returncode = None
+        self.ring = collections.deque()
+        self.ring_bytes = 0
+        self.followers = set()
+
+    def feed(self, fd, data):
+        self.ring.append((fd, data))
+        self.ring_bytes += len(data)
+        while self.ring_bytes > RING_SIZE:
+            _, old = self.ring.popleft()
+            self.ring_bytes -= len(old)
+        for q in list(self.followers):
+            if q.backlog > MAX_BACKLOG:
+                self.followers.discard(q)
+                q.put_nowait(('overrun',))
+            else:
+                q.backlog += len(data)
+                q.put_nowait(('output', fd, data))
+
+    def finish(self, returncode):
+        self.returncode = returncode
+        for q in self.followers:
+            q.put_nowait(('exit', returncode))
+        self.followers.clear()
+        if journal is not None:
+            journal.append({'op': 'done', 'job': self.id})
+        finished_jobs.append(self.id)
+        while len(finished_jobs) > KEEP_FINISHED:
+            jobs.pop(finished_jobs.popleft(), None)
+
+    def attach(self):
+        # Returns a queue of the buffered output, followed by live output
+        # and finally the exit code
+        q = Follower()
+        for fd, data in self.ring:
+            q.backlog += len(data)
+            q.put_nowait(('output', fd, data))
+        if self.returncode is None:
+            self.followers.add(q)
+        else:
+            q.put_nowait(('exit', self.returncode))
+        return q
+
+
+async def pump(job, stream, fd):
+    # Copy output to the daemon's own stdout/stderr, as when children
+    # inherited them, and to the job's ring buffer and followers
+    out = (sys.stdout if fd == 1 else sys.stderr).buffer
+    while True:
+        data = await stream.read(READ_SIZE)
+        if not data:
+            break
+        out.write(data)
+        out.flush()
+        job.feed(fd, data)
+
+
+async def pipe_reader(f):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), f)
+    return reader, transport
+
+
+async def wait_child(pid):
+    # Reaps pid and returns its wait status and rusage, which asyncio's
+    # own child watchers throw away.  Waits on a pidfd where available.
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        def wait():
+            res = os.wait4(pid, 0)
+            loop.call_soon_threadsafe(exited.set_result, res)
+        threading.Thread(target=wait, daemon=True).start()
+        _, status, rusage = await exited
+        return status, rusage
+
+    try:
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+    finally:
+        os.close(fd)
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage
+
+
+# ioprio_set has no libc wrapper
+IOPRIO_SET_NR = {
+    'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30,
+    'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282,
+}
+
+
+def ioprio_setter(cls, level):
+    # Returns a function setting our I/O priority, to be called in the child
+    import ctypes
+    nr = IOPRIO_SET_NR.get(os.uname().machine)
+    if nr is None:
+        raise OSError('ionice is not supported on this machine')
+    libc = ctypes.CDLL(None, use_errno=True)
+    IOPRIO_WHO_PROCESS = 1
+    value = (cls << 13) | level
+
+    def set_ioprio():
+        if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, value) < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    return set_ioprio
+
+
+def limit_rlimit(which, soft, hard):
+    # Never above the current hard limit, which we couldn't raise
+    _, max_hard = resource.getrlimit(which)
+    if max_hard != resource.RLIM_INFINITY:
+        soft = min(soft, max_hard)
+        hard = min(hard, max_hard)
+    resource.setrlimit(which, (soft, hard))
+
+
+def job_preexec(job):
+    # Returns a preexec_fn applying the job's resource limits, or None.
+    # Values in the request override the daemon's defaults.
+    #
+    # preexec_fn isn't safe in a process with threads in general: the
+    # child is forked with only the calling thread, so a lock another
+    # thread held stays locked for good.  Ours are the journal's executor
+    # and the wait4() fallback, which only ever block in fsync(), write()
+    # or wait4() without the GIL, and hold no lock the code below needs.
+    # For that to stay true, everything is worked out here, and the
+    # child only makes plain system calls: no logging, imports or
+    # buffered files.
+    def get(name):
+        value = job.req.get(name)
+        return job_defaults.get(name) if value is None else value
+
+    steps = []
+    if job.cgroup is not None:
+        procs = os.path.join(job.cgroup, 'cgroup.procs')
+
+        def join_cgroup():
+            fd = os.open(procs, os.O_WRONLY)
+            try:
+                os.write(fd, b'0')
+            finally:
+                os.close(fd)
+        steps.append(join_cgroup)
+    if get('mem') is not None:
+        mem = parse_size(get('mem'))
+        steps.append(lambda: limit_rlimit(resource.RLIMIT_AS, mem, mem))
+    if get('cpu') is not None:
+        # SIGXCPU first, so the job may notice and clean up
+        cpu = int(get('cpu'))
+        steps.append(lambda: limit_rlimit(resource.RLIMIT_CPU, cpu,
+                                          cpu + CPU_GRACE))
+    if get('nice') is not None:
+        nice = int(get('nice'))
+        steps.append(lambda: os.setpriority(os.PRIO_PROCESS, 0, nice))
+    if get('ionice') is not None:
+        steps.append(ioprio_setter(*parse_ionice(get('ionice'))))
+
+    if not steps:
+        return None
+
+    def preexec():
+        for step in steps:
+            step()
+    return preexec
+
+
+def make_job_cgroup(job):
+    # A cgroup of its own for each job, under the daemon's --cgroup
+    parent = job_defaults.get('cgroup')
+    if parent is None:
+        return None
+    path = os.path.join(parent, 'job-{}'.format(job.id))
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        error('Failed to create cgroup {}: {}'.format(path, e))
+        return None
+    return path
+
+
+def remove_job_cgroup(job):
+    if job.cgroup is not None:
+        try:
+            os.rmdir(job.cgroup)
+        except OSError as e:
+            # Busy if the job left processes behind
+            error('Failed to remove cgroup {}: {}'.format(job.cgroup, e))
+
+
+def current_rss():
+    # Our resident set size in KiB, or None if unknown.  A job's ru_maxrss
+    # counts the copy of the daemon it starts as before exec, so it's never
+    # much below this.
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+async def run_job(job):
+    req = job.req
+    info('Handling job {}: {}'.format(job.id, pprint.pformat(req)))
+    if journal is not None:
+        journal.append({'op': 'start', 'job': job.id})
+    ret = 127
+    job.cgroup = make_job_cgroup(job)
+    try:
+        # Requests replayed from the journal weren't checked by
+        # check_request(), so anything here may still be malformed
+        env = os.environ.copy()
+        env.update(req.get('environ') or {})
+        env['PWD'] = req['pwd']
+        fork_rss = current_rss()
+        # Not asyncio.create_subprocess_exec(), so that we can reap the
+        # child ourselves and get its rusage
+        proc = subprocess.Popen(req['cmd'], cwd=req['pwd'], env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                preexec_fn=job_preexec(job))
+    except (KeyError, TypeError, ValueError, OSError,
+            subprocess.SubprocessError) as e:
+        error('Failed to execute job {} {}: {}'.format(
+            job.id, pprint.pformat(req), str(e)))
+        remove_job_cgroup(job)
+        job.finish(ret)
+        return
+
+    start = time.time()
+    start_mono = time.monotonic()
+    running_procs[job.id] = proc
+    stdout, stdout_transport = await pipe_reader(proc.stdout)
+    stderr, stderr_transport = await pipe_reader(proc.stderr)
+    try:
+        pumps = asyncio.gather(pump(job, stdout, 1), pump(job, stderr, 2))
+        status, rusage = await wait_child(proc.pid)
+        ret = proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.monotonic() - start_mono
+        # Background processes left behind may hold the pipes open, and
+        # shouldn't keep the job going
+        try:
+            await asyncio.wait_for(pumps, PIPE_GRACE)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        stdout_transport.close()
+        stderr_transport.close()
+        remove_job_cgroup(job)
+        running_procs.pop(job.id, None)
+        job.finish(ret)
+
+    info('Done with job {}: {} ret code: {}'.format(
+        job.id, pprint.pformat(req), ret), end='\n'*5)
+    if history is not None:
+        history.append({
+            'job': job.id,
+            'start': round(start, 3),
+            'wall': round(wall, 3),
+            'user': round(rusage.ru_utime, 3),
+            'sys': round(rusage.ru_stime, 3),
+            'maxrss': rusage.ru_maxrss,
+            'forkrss': fork_rss,
+            'ret': ret,
+            'queue': req.get('queue') or 'default',
+            'pwd': req['pwd'],
+            'cmd': req['cmd'],
+        })
+
+
+def default_history_path():
+    state_home = os.environ.get('XDG_STATE_HOME') or \
+        os.path.expanduser('~/.local/state')
+    return os.path.join(state_home, 'daemon-run', 'history.jsonl')
+
+
+class History:
+    # Finished jobs, one JSON object per line.  When the file grows past
+    # max_size, it's rewritten with only the newest half.
+    def __init__(self, path, max_size):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+
+    def append(self, record):
+        try:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                size = f.tell()
+            if size > self.max_size:
+                self.trim()
+        except OSError as e:
+            error('Failed to write history: {}'.format(e))
+
+    def trim(self):
+        with open(self.path) as f:
+            lines = f.readlines()
+        keep = []
+        size = 0
+        for line in reversed(lines):
+            size += len(line)
+            if size > self.max_size // 2:
+                break
+            keep.append(line)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.writelines(reversed(keep))
+        os.replace(tmp, self.path)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+
+history = None
+journal = None
+# Daemon-wide defaults of the resource limits of jobs, and --cgroup
+job_defaults = {}
+
+
+class Journal:
+    # Write-ahead log of accepted jobs, one JSON object per line:
+    #   {"op": "submit", "job": ID, "req": {...}}
+    #   {"op": "start", "job": ID}
+    #   {"op": "done", "job": ID}
+    # Records are written and fsynced in batches: whatever is appended
+    # while one batch is being synced goes into the next one.  Once the
+    # file is both over COMPACT_MIN bytes and COMPACT_RATIO times the
+    # size of the records of unfinished jobs, it's rewritten with only
+    # those.
+    COMPACT_MIN = 1024 * 1024
+    COMPACT_RATIO = 4
+    OPS = ('submit', 'start', 'done')
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.f = None
+        self.size = 0
+        self.live = {}  # Records of unfinished jobs, by job ID
+        self.live_size = 0
+        self.batch = []
+        self.waiters = []
+        self.flushing = None
+
+    @staticmethod
+    def encode(record):
+        return (json.dumps(record, separators=(',', ':')) + '\n').encode()
+
+    def track(self, record, nbytes):
+        job_id = record['job']
+        if record['op'] == 'done':
+            for _, n in self.live.pop(job_id, ()):
+                self.live_size -= n
+        else:
+            self.live.setdefault(job_id, []).append((record, nbytes))
+            self.live_size += nbytes
+
+    def replay(self):
+        # Reads the journal left by an earlier daemon and compacts it.
+        # Returns the jobs that never started, as (ID, request), and the
+        # highest job ID seen.  Requests that don't pass check_request()
+        # are dropped, or they would stop every later daemon too.
+        max_id = 0
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end
+                        record = None
+                    if not isinstance(record, dict) or \
+                            not isinstance(record.get('job'), int) or \
+                            record.get('op') not in self.OPS:
+                        error('Ignoring bad journal record: {!r}'.format(line))
+                        continue
+                    self.track(record, len(line))
+                    max_id = max(max_id, record['job'])
+        except FileNotFoundError:
+            pass
+
+        pending = []
+        for job_id, records in sorted(self.live.items()):
+            if len(records) > 1:
+                error('Job {} was running when the daemon stopped; '
+                      'not running it again'.format(job_id))
+                continue
+            req = records[0][0].get('req')
+            message = check_request(req)
+            if message is not None:
+                error('Dropping job {} from the journal: {}'.format(
+                    job_id, message))
+            else:
+                pending.append((job_id, req))
+        self.live = {}
+        self.live_size = 0
+        for job_id, req in pending:
+            record = {'op': 'submit', 'job': job_id, 'req': req}
+            self.track(record, len(self.encode(record)))
+        self.rewrite([r for rs in self.live.values() for r, _ in rs])
+        return pending, max_id
+
+    def append(self, record):
+        # Returns a future that's done once the record is on disk
+        waiter = asyncio.get_running_loop().create_future()
+        self.batch.append(record)
+        self.waiters.append(waiter)
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush())
+        return waiter
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        while self.batch:
+            batch, waiters = self.batch, self.waiters
+            self.batch, self.waiters = [], []
+            data = []
+            for record in batch:
+                line = self.encode(record)
+                self.track(record, len(line))
+                data.append(line)
+            data = b''.join(data)
+            try:
+                await loop.run_in_executor(None, self.write, data)
+                self.size += len(data)
+                if self.size > max(self.COMPACT_MIN,
+                                   self.COMPACT_RATIO * self.live_size):
+                    records = [r for rs in self.live.values() for r, _ in rs]
+                    await loop.run_in_executor(None, self.rewrite, records)
+            except OSError as e:
+                # Keep running jobs; they're just not crash-safe
+                error('Failed to write journal: {}'.format(e))
+            for waiter in waiters:
+                waiter.set_result(None)
+        self.flushing = None
+
+    def write(self, data):
+        self.f.write(data)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def rewrite(self, records):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for record in records:
+                f.write(self.encode(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                         os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        if self.f is not None:
+            self.f.close()
+        self.f = open(self.path, 'ab')
+        self.size = self.f.tell()
+
+    async def close(self):
+        if self.flushing is not None:
+            await self.flushing
+        self.f.close()
+
+
+class Scheduler:
+    # One heap of pending jobs per named queue, each queue with its own
+    # concurrency limit.  Lower priority values run first.  Jobs are keyed
+    # by priority * AGING + submission time, so a job effectively gains
+    # one priority level per AGING seconds of waiting and can't starve.
+    # Everything runs on the event loop, so no locking is needed.
+    AGING = 60.0
+
+    def __init__(self, limits, default_limit, coalesce=True):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.coalesce = coalesce
+        self.heaps = {}
+        self.pending = {}  # By Job.key
+        self.running = {}
+        self.tasks = set()
+        self.closed = False
+
+    def submit(self, job):
+        name = job.req.get('queue') or 'default'
+        try:
+            priority = int(job.req.get('priority', 0))
+        except (TypeError, ValueError):
+            priority = 0
+        key = priority * self.AGING + time.time()
+        heapq.heappush(self.heaps.setdefault(name, []), (key, job.id, job))
+        self.pending.setdefault(job.key, job)
+        self.dispatch()
+
+    def dispatch(self):
+        if self.closed:
+            return
+        for name, heap in self.heaps.items():
+            limit = self.limits.get(name, self.default_limit)
+            while heap and self.running.get(name, 0) < limit:
+                _, _, job = heapq.heappop(heap)
+                if self.pending.get(job.key) is job:
+                    del self.pending[job.key]
+                self.running[name] = self.running.get(name, 0) + 1
+                task = asyncio.ensure_future(self.run(name, job))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def run(self, name, job):
+        try:
+            await run_job(job)
+        finally:
+            self.running[name] -= 1
+            self.dispatch()
+
+    async def close(self):
+        # Start nothing new, and wait for running jobs to finish
+        self.closed = True
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+
+async def kill_procs(procs):
+    for i in range(20):
+        alive = [(job_id, proc) for job_id, proc in procs
+                 if proc.returncode is None]
+        if not alive:
+            break
+        for job_id, proc in alive:
+            os.kill(proc.pid, signal.SIGTERM)
+        info('Sent SIGTERM to job', ' '.join(str(j) for j, _ in alive))
+        await asyncio.sleep(0.1)
+    else:
+        for job_id, proc in alive:
+            os.kill(proc.pid, signal.SIGKILL)
+        info('Sent SIGKILL to job', ' '.join(str(j) for j, _ in alive))
+
+
+async def handle_kill(args):
+    # --kill [all|JOB_ID...]
+    # Returns the IDs of the jobs killed.
+    if not args or 'all' in args:
+        procs = sorted(running_procs.items())
+    else:
+        procs = []
+        for arg in args:
+            try:
+                procs.append((int(arg), running_procs[int(arg)]))
+            except (ValueError, KeyError):
+                error('No running job {}'.format(arg))
+    if procs:
+        await kill_procs(procs)
+    else:
+        error('No running process to kill')
+    return [job_id for job_id, _ in procs]
+
+
+# Seconds to wait for the protocol magic, and between framed requests
+HANDSHAKE_TIMEOUT = 2
+IDLE_TIMEOUT = 600
+
+
+async def read_frame(reader):
+    # Returns None on EOF between frames
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    data = await reader.readexactly(decode_frame_header(header))
+    return json.loads(data.decode('utf-8'))
+
+
+def check_request(req):
+    # Returns what's wrong with the request, or None.  A missing environ
+    # means an empty one.  Anything the scheduler or job_preexec() uses
+    # is checked here, so that a bad request is answered with an error
+    # instead of failing later.
+    if not isinstance(req, dict):
+        return 'Request is not an object'
+    cmd = req.get('cmd')
+    if not isinstance(cmd, list) or not cmd or \
+            not all(isinstance(arg, str) for arg in cmd):
+        return '"cmd" must be a non-empty list of strings'
+    if not isinstance(req.get('pwd'), str):
+        return '"pwd" must be a string'
+    if req.get('environ') is None:
+        req['environ'] = {}
+    environ = req['environ']
+    if not isinstance(environ, dict) or \
+            not all(isinstance(k, str) and isinstance(v, str)
+                    for k, v in environ.items()):
+        return '"environ" must be an object of strings'
+    queue = req.get('queue')
+    if queue is not None and not isinstance(queue, str):
+        return '"queue" must be a string'
+    for name in ('priority', 'nice', 'cpu'):
+        value = req.get(name)
+        if value is not None and (isinstance(value, bool) or
+                                  not isinstance(value, int)):
+            return '"{}" must be an integer'.format(name)
+    if req.get('cpu') is not None and req['cpu'] < 0:
+        return '"cpu" must not be negative'
+    for name, parse in (('mem', parse_size), ('ionice', parse_ionice)):
+        value = req.get(name)
+        if value is None:
+            continue
+        try:
+            if isinstance(value, bool) or not isinstance(value, (int, str)):
+                raise ValueError(value)
+            parse(value)
+        except ValueError:
+            return 'Invalid "{}": {!r}'.format(name, value)
+    return None
+
+
+async def handle_request(scheduler, req):
+    # Returns the response, and the job whose output is to be streamed to
+    # the client, if any
+    info('Parsed request: {}'.format(pprint.pformat(req)))
+    message = check_request(req)
+    if message is not None:
+        return {'status': 'error', 'message': message}, None
+    cmd = req['cmd']
+    if cmd[0] == '--kill':
+        return {'status': 'ok', 'killed': await handle_kill(cmd[1:])}, None
+    if cmd[0] in ('--history', '--stats'):
+        records = history.read() if history is not None else []
+        return {'status': 'ok', 'history': records}, None
+    if cmd[0] == '--attach':
+        try:
+            job = jobs[int(cmd[1])]
+        except (IndexError, ValueError, KeyError):
+            return {'status': 'error',
+                    'message': 'No such job: {}'.format(cmd[1:])}, None
+        return {'status': 'ok', 'job': job.id}, job
+
+    key = request_key(req)
+    if req.get('restart'):
+        # Latest wins: identical running jobs are out of date
+        stale = [(job_id, proc) for job_id, proc in running_procs.items()
+                 if jobs[job_id].key == key]
+        if stale:
+            await kill_procs(stale)
+    if scheduler.coalesce:
+        # Identical to a job that hasn't started yet, which will do
+        pending = scheduler.pending.get(key)
+        if pending is not None:
+            info('Coalesced request into job {}'.format(pending.id))
+            return ({'status': 'ok', 'job': pending.id, 'coalesced': True},
+                    pending if req.get('follow') else None)
+    job = Job(next(job_ids), req)
+    jobs[job.id] = job
+    if journal is not None:
+        # Acknowledge only once the job is on disk
+        synced = journal.append({'op': 'submit', 'job': job.id, 'req': req})
+        scheduler.submit(job)
+        await synced
+    else:
+        scheduler.submit(job)
+    return {'status': 'ok', 'job': job.id}, job if req.get('follow') else None
+
+
+async def follow_job(job, writer):
+    # Each chunk of output is sent as an 'output' frame followed by the
+    # raw bytes, so it needn't be encoded into JSON
+    q = job.attach()
+    try:
+        while True:
+            item = await q.get()
+            if item[0] == 'output':
+                _, fd, data = item
+                q.backlog -= len(data)
+                writer.write(encode_frame(
+                    {'status': 'output', 'fd': fd, 'size': len(data)}))
+                writer.write(data)
+            elif item[0] == 'exit':
+                writer.write(encode_frame(
+                    {'status': 'exit', 'returncode': item[1]}))
+                break
+            else:
+                writer.write(encode_frame(
+                    {'status': 'error',
+                     'message': 'Client too slow, output dropped'}))
+                break
+            await writer.drain()
+        await writer.drain()
+    finally:
+        job.followers.discard(q)
+
+
+async def handle_framed(scheduler, reader, writer):
+    while True:
+        req = await asyncio.wait_for(read_frame(reader), IDLE_TIMEOUT)
+        if req is None:
+            break
+        resp, job = await handle_request(scheduler, req)
+        writer.write(encode_frame(resp))
+        await writer.drain()
+        if job is not None:
+            await follow_job(job, writer)
+
+
+async def handle_legacy(scheduler, reader, writer, head):
+    # Pickled request from an old client, which sends one message and
+    # shuts down its write side.  Only enabled with --legacy-pickle:
+    # unpickling lets whoever can reach the socket run arbitrary code.
+    req_s = head + await asyncio.wait_for(reader.read(), IDLE_TIMEOUT)
+    info('Received {} bytes'.format(len(req_s)))
+
+    try:
+        req = pickle.loads(req_s)
+    except (pickle.UnpicklingError, ValueError, TypeError, EOFError) as e:
+        error(str(e))
+        writer.write(b'Failed to unpickle message')
+    else:
+        resp, _ = await handle_request(scheduler, req)
+        if resp['status'] == 'error':
+            writer.write('Error: {}'.format(resp['message']).encode())
+        elif 'job' in resp:
+            writer.write('OK job {}'.format(resp['job']).encode())
+        else:
+            writer.write(b'OK')
+    await writer.drain()
+
+
+async def daemon_handle(scheduler, legacy_pickle, reader, writer):
+    info('Accepted new connection')
+    try:
+        try:
+            head = await asyncio.wait_for(reader.readexactly(len(MAGIC)),
+                                          HANDSHAKE_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            head = e.partial
+
+        if head == MAGIC:
+            await handle_framed(scheduler, reader, writer)
+        elif head and legacy_pickle:
+            await handle_legacy(scheduler, reader, writer, head)
+        else:
+            error('Unknown protocol; old clients need --legacy-pickle')
+    except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+        error(str(e) or type(e).__name__)
+    finally:
+        writer.close()
+
+
+async def serve(sock, scheduler, legacy_pickle):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+
+    if journal is not None:
+        replay_journal(scheduler)
+
+    server = await asyncio.start_unix_server(
+        functools.partial(daemon_handle, scheduler, legacy_pickle),
+        sock=sock)
+    info('Listing on Unix-domain socket', sock.getsockname())
+    await stop.wait()
+
+    server.close()
+    await server.wait_closed()
+    info('Waiting for running jobs')
+    await scheduler.close()
+    if journal is not None:
+        # Pending jobs stay in the journal, for the next daemon to run
+        await journal.close()
+
+
+def replay_journal(scheduler):
+    global job_ids
+    pending, max_id = journal.replay()
+    job_ids = itertools.count(max_id + 1)
+    for job_id, req in pending:
+        info('Resuming job {} from the journal'.format(job_id))
+        job = Job(job_id, req)
+        jobs[job.id] = job
+        scheduler.submit(job)
+
+
+def parse_ionice_arg(s):
+    try:
+        parse_ionice(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return s
+
+
+def parse_size_arg(s):
+    try:
+        return parse_size(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid size: {}'.format(s))
+
+
+def daemon(argv):
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0], description='Run the daemon')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Run up to JOBS commands concurrently in each '
+                             'queue not given with -Q (default: %(default)s)')
+    parser.add_argument('-Q', '--queue', action='append', default=[],
+                        metavar='NAME=LIMIT',
+                        help='Concurrency limit of a named queue')
+    parser.add_argument('--default-nice', type=int, metavar='N',
+                        help='Nice level of jobs')
+    parser.add_argument('--default-ionice', type=parse_ionice_arg,
+                        metavar='CLASS[:LEVEL]',
+                        help='I/O scheduling class (idle, best-effort or '
+                             'realtime) and level of jobs')
+    parser.add_argument('--default-mem', type=parse_size_arg, metavar='SIZE',
+                        help='Address space limit (RLIMIT_AS) of jobs, '
+                             'e.g. 4G')
+    parser.add_argument('--default-cpu', type=int, metavar='SECONDS',
+                        help='CPU time limit (RLIMIT_CPU) of jobs')
+    parser.add_argument('--cgroup', metavar='DIR',
+                        help='Run each job in a child cgroup of this '
+                             'delegated cgroup v2 directory')
+    parser.add_argument('--no-coalesce', action='store_true',
+                        help='Run every request, even if an identical one '
+                             '(same directory, command, environment, queue '
+                             'and limits) is still pending')
+    parser.add_argument('--history-file', default=default_history_path(),
+                        help='Where to record finished jobs '
+                             '(default: %(default)s)')
+    parser.add_argument('--history-size', type=int, default=1024 * 1024,
+                        metavar='BYTES',
+                        help='Approximate size limit of the history file '
+                             '(default: %(default)s)')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='Keep accepted jobs in this file, so that jobs '
+                             'that haven\'t started are run by the next '
+                             'daemon if this one stops or crashes')
+    parser.add_argument('--legacy-pickle', action='store_true',
+                        help='Also accept pickled requests from old clients '
+                             '(unsafe: anyone who can reach the socket can '
+                             'run arbitrary code in the daemon)')
+    args = parser.parse_args(argv)
+
+    limits = {}
+    for spec in args.queue:
+        name, _, limit = spec.partition('=')
+        try:
+            limits[name] = max(int(limit), 1)
+        except ValueError:
+            parser.error('Invalid queue spec: {}'.format(spec))
+
+    path = get_socket_path()
+    if not path.startswith('\0'):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(path)
+    s.listen(128)
+
+    global history, journal
+    history = History(args.history_file, args.history_size)
+    if args.journal:
+        journal = Journal(args.journal)
+
+    job_defaults.update(nice=args.default_nice, ionice=args.default_ionice,
+                        mem=args.default_mem, cpu=args.default_cpu)
+    if args.cgroup:
+        if os.access(os.path.join(args.cgroup, 'cgroup.procs'), os.W_OK) \
+                and os.access(args.cgroup, os.W_OK):
+            job_defaults['cgroup'] = args.cgroup
+        else:
+            error('Cgroup {} is not writable; not using it'.format(
+                args.cgroup))
+
+    scheduler = Scheduler(limits, max(args.jobs, 1), not args.no_coalesce)
+    asyncio.run(serve(s, scheduler, args.legacy_pickle))
+    sys.exit(128 + signal.SIGINT)
@@ -39,6 +39,9 @@ import re
 from typing import Dict, Iterator, Tuple
 
 
+CHUNK_SIZE = 1024 * 1024
+
+
 class FileType(enum.Enum):
     OBJ = enum.auto()
     SYM = enum.auto()
@@ -85,6 +88,15 @@ def collect_installed_files() -> Dict[str, FileDetail]:
     return res
 
 
+def md5_file(path: str) -> str:
+    h = hashlib.md5()
+    view = memoryview(bytearray(CHUNK_SIZE))
+    with open(path, 'rb', buffering=0) as f:
+        while (n := f.readinto(view)):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
 def is_modified(detail: FileDetail, path: str) -> bool:
     try:
         target = os.readlink(path)
@@ -93,11 +105,9 @@ def is_modified(detail: FileDetail, path: str) -> bool:
         pass
 
     try:
-        with open(path, 'rb') as f:
-            content = f.read()
+        return md5_file(path) != detail.md5
     except (OSError, IOError):
         return True
-    return hashlib.md5(content).hexdigest() != detail.md5
 
 
 def find_files(dir: str, installed: Dict[str, FileDetail]) \
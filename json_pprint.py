@@ -34,91 +34,923 @@
 #
 
 import argparse
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import concurrent.futures
+import contextlib
 import json
+import locale
+import mmap
+import os
 import pprint
 import re
 import sys
+import time
 
 
-def lpc_2_json(lpc_str):
-    # I deal with some lpc data. Convert them to JSON
-    convert_dict = [
-        ('([', '{'),
-        (',])', '}'),
-        ('])', '}'),
+def decode(data):
+    # Like json.loads() does for bytes, but falls back to the locale's
+    # encoding for files in neither UTF-8, UTF-16 nor UTF-32
+    try:
+        return str(data, json.detect_encoding(data[:4]), 'surrogatepass')
+    except UnicodeDecodeError:
+        return str(data, locale.getpreferredencoding(False))
+
 
-        ('({', '['),
-        (',})', ']'),
-        ('})', ']'),
-    ]
+def read_input(f, stats):
+    # All of binary file f, decoded.  Regular files are mapped rather than
+    # read, so the decoded text is the only copy in memory.
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # Pipes, terminals and empty files
+        data = f.read()
+        stats.input(len(data), 'read')
+        return decode(data)
+    with mm:
+        stats.input(len(mm), 'mapped')
+        return decode(mm)
 
-    for old, new in convert_dict:
-        lpc_str = lpc_str.replace(old, new)
 
-    return lpc_str
+class Stats:
+    # Input size and per-phase wall time, for --stats
+    def __init__(self):
+        self.nbytes = 0
+        self.how = None
+        self.records = 0
+        self.failed = 0
+        self.phases = []
 
+    def input(self, nbytes, how):
+        self.nbytes += nbytes
+        self.how = how
 
-def fix_json(src):
-    # I have to deal with a lot of non-standard JSON.
-    # Try to fix them whenever possible.
+    @contextlib.contextmanager
+    def phase(self, name, rate=True):
+        # rate: whether to report throughput, for phases that go through
+        # the whole input
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start, rate))
 
-    # Fix property names missing quotes
-    src = re.sub(r'([\{,]\s*)(\w+)(?=\s*:)', r'\1"\2"', src)
-    return src
+    def report(self, file=sys.stderr):
+        mb = self.nbytes / 1e6
+        if self.how:
+            print('{:>10}: {:.1f} MB ({})'.format('input', mb, self.how),
+                  file=file)
+        if self.records:
+            print('{:>10}: {}, {} failed'.format(
+                'records', self.records, self.failed), file=file)
+        for name, seconds, rate in self.phases:
+            if rate and self.how and seconds:
+                print('{:>10}: {:.3f} s, {:.1f} MB/s'.format(
+                    name, seconds, mb / seconds), file=file)
+            else:
+                print('{:>10}: {:.3f} s'.format(name, seconds), file=file)
 
 
 def json_loads(s):
     return json.loads(s, strict=False, object_pairs_hook=OrderedDict)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('file', nargs='?',
-                        help='Input file. Default is standard input.')
-    parser.add_argument('-F', '--format', type=str, default='json',
-                        choices=['python', 'json', 'keys'],
-                        help='Output format')
-    parser.add_argument('key', nargs='*')
-    options = parser.parse_args()
+# --incremental reads the input in chunks of CHUNK_SIZE characters.  The
+# first HOLD_SIZE characters of output are held back, so that we can still
+# fall back to tolerant_loads() if the input turns out not to be JSON.
+CHUNK_SIZE = 1024 * 1024
+HOLD_SIZE = 1024 * 1024
 
-    if options.file and options.file != '-':
-        with open(options.file, 'r') as f:
-            src = f.read()
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+DECODER = json.JSONDecoder(strict=False, object_pairs_hook=OrderedDict)
+
+
+def truncated(e):
+    # Whether a decode error may just be the end of the buffer
+    return e.msg.startswith('Unterminated') or e.pos >= len(e.doc) - 6
+
+
+class Reader:
+    # Sliding window over a text stream.  Everything read is also kept in
+    # `kept`, until that is set to None.
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0  # Of buf[0] in the input
+        self.eof = False
+        self.kept = []
+
+    def more(self):
+        # Returns False at EOF
+        if self.eof:
+            return False
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.kept is not None:
+            self.kept.append(chunk)
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # Skips whitespace.  Returns the next character, or '' at EOF.
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ''
+
+    def error(self, msg):
+        return json.JSONDecodeError(msg, self.buf, self.pos)
+
+
+class IncrementalPrinter:
+    # Writes the same as json.dump(..., ensure_ascii=False, indent=4), but
+    # only holds a window of the input.  Values that fit in the window are
+    # decoded whole; larger objects and arrays are streamed through.
+    # Unlike json_loads(), duplicate keys are kept.
+    def __init__(self, reader, write):
+        self.reader = reader
+        self.write = write
+
+    def document(self):
+        self.value(0)
+        if self.reader.peek():
+            raise self.reader.error('Extra data')
+
+    def value(self, indent):
+        r = self.reader
+        c = r.peek()
+        if not c:
+            raise r.error('Expecting value')
+        while True:
+            try:
+                value, end = DECODER.raw_decode(r.buf, r.pos)
+            except json.JSONDecodeError as e:
+                if r.eof:
+                    raise
+                if c in '{[' and len(r.buf) - r.pos >= CHUNK_SIZE:
+                    return self.container(c, indent)
+                if truncated(e) or len(r.buf) - r.pos < CHUNK_SIZE:
+                    r.more()
+                    continue
+                raise
+            if c not in '{["' and NUMBER_TAIL.fullmatch(r.buf, end) and \
+                    r.more():
+                continue  # A number may go on in the next chunk
+            break
+        r.pos = end
+        self.write(json.dumps(value, ensure_ascii=False, indent=4).replace(
+            '\n', '\n' + ' ' * indent))
+
+    def container(self, c, indent):
+        r = self.reader
+        close = '}' if c == '{' else ']'
+        r.pos += 1
+        if r.peek() == close:
+            r.pos += 1
+            self.write(c + close)
+            return
+
+        self.write(c)
+        sep = '\n' + ' ' * (indent + 4)
+        while True:
+            self.write(sep)
+            if c == '{':
+                self.key()
+            self.value(indent + 4)
+            d = r.peek()
+            if d == ',':
+                r.pos += 1
+                sep = ',\n' + ' ' * (indent + 4)
+            elif d == close:
+                r.pos += 1
+                break
+            else:
+                raise r.error('Expecting \',\' delimiter')
+        self.write('\n' + ' ' * indent + close)
+
+    def key(self):
+        r = self.reader
+        if r.peek() != '"':
+            raise r.error('Expecting property name enclosed in double quotes')
+        while True:
+            try:
+                key, end = json.decoder.scanstring(r.buf, r.pos + 1, False)
+                break
+            except json.JSONDecodeError as e:
+                if not truncated(e) or not r.more():
+                    raise
+        r.pos = end
+        if r.peek() != ':':
+            raise r.error('Expecting \':\' delimiter')
+        r.pos += 1
+        self.write(json.dumps(key, ensure_ascii=False) + ': ')
+
+
+# Skipping over JSON text without decoding it.  SKIP_CONTAINER stops at
+# the next bracket outside strings.
+SKIP_CONTAINER = re.compile(
+    r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*', re.S)
+SKIP_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+SKIP_SCALAR = re.compile(r'[^,\]}\s]*')
+ESCAPE = re.compile(r'\\.', re.S)
+NOT_BRACKET = re.compile(r'[^\[\]{}]+')
+NOT_BRACKET_OR_COMMA = re.compile(r'[^\[\]{},]+')
+INNER_PAIR = re.compile(r'\([^()]*\)')
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{},"]', re.S)
+BRACKETS = str.maketrans('[]{}', '()()')
+# Containers with more than SKIP_WALK brackets, and arrays past SKIP_WALK
+# elements, are skipped SKIP_BLOCK characters at a time
+SKIP_WALK = 64
+SKIP_BLOCK = 64 * 1024
+
+
+def skip_ws(src, pos):
+    return WHITESPACE.match(src, pos).end()
+
+
+def walk(src, pos, depth, steps=-1):
+    # Walks bracket by bracket from pos, outside strings and `depth` deep,
+    # until back at depth 0 or after `steps` brackets.  Returns the new
+    # position and depth.
+    while steps:
+        pos = SKIP_CONTAINER.match(src, pos).end()
+        c = src[pos:pos + 1]
+        if c in ('{', '['):
+            depth += 1
+        elif c in ('}', ']'):
+            depth -= 1
+            if not depth:
+                return pos + 1, 0
+        else:
+            raise json.JSONDecodeError('Unterminated value', src, pos)
+        pos += 1
+        steps -= 1
+    return pos, depth
+
+
+def next_block(src, pos, in_string):
+    # The block from pos, and what of it is outside strings, escapes
+    # dropped.  Returns the end of the block, that text, and whether the
+    # block ends in a string.
+    end = min(pos + SKIP_BLOCK, len(src))
+    block = src[pos:end]
+    if '\\' in block:
+        block = ESCAPE.sub('', block)
+        if block.endswith('\\') and end < len(src):
+            # Don't split an escape
+            end += 1
+            block = ESCAPE.sub('', src[pos:end])
+    parts = block.split('"')
+    outside = ''.join(parts[1::2] if in_string else parts[::2])
+    if len(parts) % 2 == 0:
+        in_string = not in_string
+    return end, outside, in_string
+
+
+def end_string(src, pos, in_string):
+    if not in_string:
+        return pos
+    m = STRING_REST.match(src, pos)
+    if m is None:
+        raise json.JSONDecodeError('Unterminated string', src, pos)
+    return m.end()
+
+
+def skip_blocks(src, pos, depth):
+    # Like walk(), but a block at a time, with only str methods and
+    # regular expressions looking at each character.  Escapes are
+    # dropped, then strings, by splitting at the quotes.  Pairs of
+    # brackets in what's left cancel out, leaving the closing brackets
+    # that take us out of containers and the opening ones that take us
+    # into new ones.  Only the block where we may get back to depth 0 is
+    # walked bracket by bracket.
+    in_string = False
+    while True:
+        end, outside, ends_in_string = next_block(src, pos, in_string)
+        brackets = NOT_BRACKET.sub('', outside).translate(BRACKETS)
+        while '()' in brackets:
+            brackets = brackets.replace('()', '')
+        closes = brackets.count(')')
+        if closes >= depth or end == len(src):
+            break
+        depth += len(brackets) - 2 * closes
+        in_string = ends_in_string
+        pos = end
+    return walk(src, end_string(src, pos, in_string), depth)[0]
+
+
+def skip_elements(src, pos, n):
+    # In an array, outside strings and containers: skips n elements by
+    # counting commas, the way skip_blocks() counts brackets.  Pairs of
+    # brackets are dropped with what's between them, and in what's left
+    # the commas outside the remaining brackets are ours.  Only the block
+    # where the count is reached, or the array ends, is walked token by
+    # token.  Returns the position of the element, or None if the array
+    # ends first, and how many of the n are left.
+    depth = 0
+    in_string = False
+    while n:
+        end, outside, ends_in_string = next_block(src, pos, in_string)
+        tokens = NOT_BRACKET_OR_COMMA.sub('', outside).translate(BRACKETS)
+        nested = 1
+        while nested:
+            tokens, nested = INNER_PAIR.subn('', tokens)
+        # Closing brackets all come before opening ones now
+        closes = tokens.count(')')
+        if closes > depth or end == len(src):
+            break
+        pieces = tokens.replace('(', ')').split(')')
+        commas = sum(piece.count(',') for i, piece in enumerate(pieces)
+                     if (depth - i if i <= closes else
+                         depth - 2 * closes + i) == 0)
+        if commas >= n:
+            break
+        n -= commas
+        depth += len(pieces) - 1 - 2 * closes
+        in_string = ends_in_string
+        pos = end
+
+    if not n:
+        return pos, 0
+    for m in TOKEN.finditer(src, end_string(src, pos, in_string)):
+        c = m.group()
+        if c == ',':
+            if not depth:
+                n -= 1
+                if not n:
+                    return skip_ws(src, m.end()), 0
+        elif c in ('[', '{'):
+            depth += 1
+        elif c in (']', '}'):
+            if not depth:
+                return None, n
+            depth -= 1
+        elif c == '"':
+            raise json.JSONDecodeError('Unterminated string', src, m.start())
+    raise json.JSONDecodeError('Unterminated value', src, len(src))
+
+
+def skip_value(src, pos):
+    # Returns the end of the value at pos.  Only strings and nesting are
+    # checked.
+    c = src[pos:pos + 1]
+    if c == '"':
+        m = SKIP_STRING.match(src, pos)
+        if m is None:
+            raise json.JSONDecodeError('Unterminated string', src, pos)
+        return m.end()
+    if c in ('{', '['):
+        pos, depth = walk(src, pos, 0, SKIP_WALK)
+        return skip_blocks(src, pos, depth) if depth else pos
+    end = SKIP_SCALAR.match(src, pos).end()
+    if end == pos:
+        raise json.JSONDecodeError('Expecting value', src, pos)
+    return end
+
+
+def find_member(src, pos, key):
+    # Object at pos.  Returns the position of the value of key, or None.
+    # Like json_loads(), the last of duplicate keys wins.
+    found = None
+    pos = skip_ws(src, pos + 1)
+    if src[pos:pos + 1] == '}':
+        return None
+    while True:
+        if src[pos:pos + 1] != '"':
+            raise json.JSONDecodeError(
+                'Expecting property name enclosed in double quotes', src, pos)
+        name, pos = json.decoder.scanstring(src, pos + 1, False)
+        pos = skip_ws(src, pos)
+        if src[pos:pos + 1] != ':':
+            raise json.JSONDecodeError('Expecting \':\' delimiter', src, pos)
+        pos = skip_ws(src, pos + 1)
+        if name == key:
+            found = pos
+        pos = skip_ws(src, skip_value(src, pos))
+        c = src[pos:pos + 1]
+        if c == '}':
+            return found
+        if c != ',':
+            raise json.JSONDecodeError('Expecting \',\' delimiter', src, pos)
+        pos = skip_ws(src, pos + 1)
+
+
+def find_element(src, pos, index):
+    # Array at pos.  Returns the position of element index, or None.  The
+    # first SKIP_WALK elements are stepped over one by one, and the rest
+    # with skip_elements().
+    starts = []
+    pos = skip_ws(src, pos + 1)
+    if src[pos:pos + 1] == ']':
+        return None
+    while True:
+        if len(starts) == index:
+            return pos
+        if len(starts) == SKIP_WALK:
+            if index < 0:
+                # Count the rest of them first
+                _, left = skip_elements(src, pos, len(src))
+                index += SKIP_WALK + len(src) - left + 1
+                if index < SKIP_WALK:
+                    return starts[index] if index >= 0 else None
+            return skip_elements(src, pos, index - SKIP_WALK)[0]
+        starts.append(pos)
+        pos = skip_ws(src, skip_value(src, pos))
+        c = src[pos:pos + 1]
+        if c == ']':
+            break
+        if c != ',':
+            raise json.JSONDecodeError('Expecting \',\' delimiter', src, pos)
+        pos = skip_ws(src, pos + 1)
+    if index < 0 and -index <= len(starts):
+        return starts[index]
+    return None
+
+
+def extract(src, keys):
+    # Decodes only the value at the key path, skipping over the rest of
+    # the text.  Raises KeyError with the first key not found, or
+    # ValueError if src isn't standard JSON.
+    pos = skip_ws(src, 0)
+    for key in keys:
+        c = src[pos:pos + 1]
+        if c == '{':
+            pos = find_member(src, pos, key)
+        elif c == '[':
+            try:
+                pos = find_element(src, pos, int(key))
+            except ValueError:
+                raise KeyError(key)
+        else:
+            DECODER.raw_decode(src, pos)  # Not found, if it's JSON at all
+            pos = None
+        if pos is None:
+            raise KeyError(key)
+    return DECODER.raw_decode(src, pos)[0]
+
+
+# I deal with a lot of non-standard JSON, and with LPC data, where
+# mappings are ([ key: value ]) and arrays ({ value }).  tolerant_loads()
+# parses both, and mixes of them, also accepting property names without
+# quotes and trailing commas.  Standard JSON goes straight to the C
+# decoder.  Anything else is first rewritten into JSON by normalize(),
+# which is all str.replace() and re.sub() and so nearly as fast, and only
+# if that doesn't parse either does TolerantParser go through it, which
+# also gives error positions in the original text.
+
+# Splits the text into code and string literals, as does str.split('"')
+# unless the strings have escaped quotes
+STRING = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"', re.S)
+# With LPC's trailing commas first, as LPC's save_object() writes them
+LPC_BRACKETS = ((',])', '}'), ('])', '}'), (',})', ']'), ('})', ']'),
+                ('([', '{'), ('({', '['))
+TRAILING_COMMA = re.compile(r',(?=[ \t\n\r]*[\]}])')
+EMPTY_ELEMENT = re.compile(r'[\[{,][ \t\n\r]*,')
+# Outside strings, a word before a colon can only be a property name.
+# Splitting on it and joining with quotes is quicker than re.sub().
+UNQUOTED_KEY = re.compile(r'(?<=[{, \t\n\r])(\w+)(?=[ \t\n\r]*:)')
+
+
+def normalize(src):
+    # src rewritten into JSON, or None where it's better left to
+    # TolerantParser.  The code between the string literals is joined
+    # with NULs, rewritten in a few passes of C code and put back.  Each
+    # regex pass is skipped if a quicker check shows it has nothing to do.
+    if '\\"' in src:
+        parts = STRING.split(src)
     else:
-        src = sys.stdin.read()
+        parts = src.split('"')
+        if len(parts) % 2 == 0:  # Unterminated string
+            return None
+    code = '\0'.join(parts[0::2])
+    if code.count('\0') != len(parts) // 2:  # NUL outside the strings
+        return None
+    # Only commas after a value are dropped, or [,] would become []
+    if EMPTY_ELEMENT.search(code):
+        return None
+    for old, new in LPC_BRACKETS:
+        code = code.replace(old, new)
+    if TRAILING_COMMA.search(code):
+        code = TRAILING_COMMA.sub('', code)
+    # Every colon right after a string means every property name is quoted
+    if code.count(':') != code.count('\0:'):
+        code = '"'.join(UNQUOTED_KEY.split(code))
+    parts[0::2] = code.split('\0')
+    return '"'.join(parts)
 
-    try:
-        data = json_loads(src)
-    except ValueError:
-        data = None
 
-    if data is None:
+# A property name, with or without quotes, and its colon.  NEXT is what
+# may follow a member: a comma, and the next property name.
+KEY = r'(?:"([^"\\]*(?:\\.[^"\\]*)*)"|(\w+))[ \t\n\r]*:[ \t\n\r]*'
+FIRST_KEY = re.compile(KEY, re.S)
+NEXT = re.compile(r'[ \t\n\r]*(?:(,)[ \t\n\r]*(?:' + KEY + ')?)?', re.S)
+SEPARATOR = re.compile(r'[ \t\n\r]*(,?)[ \t\n\r]*')
+SCAN_FAILURES = 16
+
+
+def property_name(m, i):
+    # From a match of KEY, whose groups start at i
+    key = m.group(i)
+    if key is None:
+        return m.group(i + 1)
+    if '\\' in key:
+        key = json.decoder.scanstring(m.string, m.start(i), False)[0]
+    return key
+
+
+class TolerantParser:
+    # Recursive descent over the containers.  Scalars are left to the C
+    # scanner, and so are whole JSON objects and arrays, unless they start
+    # with a property name without quotes.  The C scanner stops at the
+    # first non-standard character, so only the containers around those
+    # are parsed here.  Each stop costs time linear in the position (for
+    # the line number in the error), so after SCAN_FAILURES of them it's
+    # only used for scalars.
+    def __init__(self, src):
+        self.src = src
+        self.failures = 0
+
+    def document(self):
+        src = self.src
+        value, pos = self.value(skip_ws(src, 0))
+        pos = skip_ws(src, pos)
+        if pos != len(src):
+            raise json.JSONDecodeError('Extra data', src, pos)
+        return value
+
+    def value(self, pos):
+        # Returns the value at pos and the position after it
+        src = self.src
+        c = src[pos:pos + 1]
+        if c == '(':
+            c = src[pos:pos + 2]
+            if c == '([':
+                return self.mapping(pos + 2, '])')
+            if c == '({':
+                return self.array(pos + 2, '})')
+        elif c == '{' or c == '[':
+            i = skip_ws(src, pos + 1)
+            if self.failures < SCAN_FAILURES and (
+                    c == '[' or src[i:i + 1] in ('"', '}')):
+                try:
+                    return DECODER.scan_once(src, pos)
+                except (StopIteration, json.JSONDecodeError):
+                    self.failures += 1
+            if c == '{':
+                return self.mapping(pos + 1, '}')
+            return self.array(pos + 1, ']')
+        try:
+            return DECODER.scan_once(src, pos)
+        except StopIteration:
+            raise json.JSONDecodeError('Expecting value', src, pos)
+
+    # mapping() and array() take the position after the opening bracket.
+    # Their loops are the hot path, so names are looked up once and
+    # scalars are scanned inline.
+
+    def mapping(self, pos, close):
+        src = self.src
+        items = OrderedDict()
+        pos = skip_ws(src, pos)
+        if src.startswith(close, pos):
+            return items, pos + len(close)
+        m = FIRST_KEY.match(src, pos)
+        if m is None:
+            raise json.JSONDecodeError('Expecting property name', src, pos)
+        key = property_name(m, 1)
+        pos = m.end()
+
+        match_next = NEXT.match
+        scan_once = DECODER.scan_once
+        value = self.value
+        while True:
+            if src[pos:pos + 1] in ('{', '[', '('):
+                items[key], pos = value(pos)
+            else:
+                try:
+                    items[key], pos = scan_once(src, pos)
+                except StopIteration:
+                    raise json.JSONDecodeError('Expecting value', src, pos)
+            m = match_next(src, pos)
+            pos = m.end()
+            if (m.lastindex or 0) > 1:
+                key = property_name(m, 2)
+                continue
+            if src.startswith(close, pos):
+                return items, pos + len(close)
+            raise json.JSONDecodeError(
+                'Expecting property name' if m.lastindex else
+                'Expecting \',\' delimiter', src, pos)
+
+    def array(self, pos, close):
+        src = self.src
+        items = []
+        pos = skip_ws(src, pos)
+        match_sep = SEPARATOR.match
+        scan_once = DECODER.scan_once
+        value = self.value
+        append = items.append
+        while not src.startswith(close, pos):
+            if src[pos:pos + 1] in ('{', '[', '('):
+                item, pos = value(pos)
+            else:
+                try:
+                    item, pos = scan_once(src, pos)
+                except StopIteration:
+                    raise json.JSONDecodeError('Expecting value', src, pos)
+            append(item)
+            m = match_sep(src, pos)
+            pos = m.end()
+            if not m.group(1):
+                if src.startswith(close, pos):
+                    break
+                raise json.JSONDecodeError(
+                    'Expecting \',\' delimiter', src, pos)
+        return items, pos + len(close)
+
+
+def tolerant_loads(src):
+    # Everything before where the C decoder gives up is standard JSON, so
+    # only the rest needs normalize(), from the comma or bracket before
+    # it.  A bad escape is inside a string, and no rewrite would help.
+    try:
+        return json_loads(src)
+    except json.JSONDecodeError as e:
+        if e.msg.startswith('Invalid \\'):
+            return TolerantParser(src).document()
+        start = e.pos
+    while start and src[start - 1] in ' \t\n\r':
+        start -= 1
+    if start and src[start - 1] in '[{,':
+        start -= 1
+    tail = normalize(src[start:])
+    if tail is not None:
         try:
-            data = json_loads(fix_json(src))
+            return json_loads(src[:start] + tail)
         except ValueError:
-            data = None
+            pass
+    return TolerantParser(src).document()
+
 
-    if data is None:
-        data = json_loads(fix_json(lpc_2_json(src)))
+EXTRACT_MIN = 64 * 1024
 
-    for key in options.key:
+
+def load(src, keys):
+    # Returns the value at the key path.  Raises KeyError with the first
+    # key not found, or ValueError if src can't be parsed.  Documents
+    # smaller than EXTRACT_MIN are faster to decode whole.
+    if keys and len(src) >= EXTRACT_MIN:
+        try:
+            return extract(src, keys)
+        except ValueError:  # Not standard JSON
+            pass
+    data = tolerant_loads(src)
+    for key in keys:
         try:
             data = data[key]
-        except KeyError:
+        except (KeyError, TypeError):
             try:
                 data = data[int(key)]
-            except (KeyError, ValueError):
-                sys.exit('{0} not found'.format(key))
+            except (KeyError, IndexError, TypeError, ValueError):
+                raise KeyError(key)
+    return data
 
-    fmt = options.format.lower()
+
+def dumps(data, fmt):
+    # Without the final newline.  Raises TypeError for the keys of
+    # something that isn't an object.
     if fmt == 'keys':
-        print('\n'.join(data.keys()))
+        if not isinstance(data, dict):
+            raise TypeError('Not an object')
+        return '\n'.join(data.keys())
     elif fmt == 'json':
-        json.dump(data, sys.stdout, ensure_ascii=False, indent=4)
+        return json.dumps(data, ensure_ascii=False, indent=4)
     else:
-        pprint.pprint(data)
+        return pprint.pformat(data)
+
+
+# --lines and --stream give records in chunks of about RECORD_CHUNK
+# characters.  With --jobs, JOB_QUEUE chunks per process are in flight.
+RECORD_CHUNK = 256 * 1024
+JOB_QUEUE = 4
+
+
+def skip_document(src, pos):
+    # Like skip_value(), but also for LPC
+    if src[pos:pos + 2] in ('([', '({'):
+        end = skip_value(src, pos + 1)
+        if src[end:end + 1] != ')':
+            raise json.JSONDecodeError('Expecting \')\'', src, end)
+        return end + 1
+    return skip_value(src, pos)
+
+
+def line_records(f, stats):
+    # (name, text) of every line of binary file f that isn't blank
+    stats.input(0, 'read')
+    for n, line in enumerate(f, 1):
+        stats.nbytes += len(line)
+        if line.strip():
+            yield 'Line {}'.format(n), decode(line)
+
+
+def stream_records(src):
+    # (name, text) of documents one after another, with or without
+    # whitespace in between.  Only their ends are found here; they are
+    # parsed along with the key path and so maybe in another process.
+    n = 0
+    pos = skip_ws(src, 0)
+    while pos < len(src):
+        n += 1
+        try:
+            end = skip_document(src, pos)
+        except ValueError:
+            end = len(src)  # The parser will tell what's wrong
+        yield 'Document {}'.format(n), src[pos:end]
+        pos = skip_ws(src, end)
+
+
+def chunks(records):
+    chunk = []
+    size = 0
+    for record in records:
+        chunk.append(record)
+        size += len(record[1])
+        if size >= RECORD_CHUNK:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+
+def format_records(records, keys, fmt):
+    # Returns the output for a chunk of records, and error messages for
+    # those that failed.  Runs in the worker processes with --jobs.
+    out = []
+    errors = []
+    for name, src in records:
+        try:
+            out.append(dumps(load(src, keys), fmt) + '\n')
+        except KeyError as e:
+            errors.append('{}: {} not found'.format(name, e.args[0]))
+        except TypeError as e:
+            errors.append('{}: {}'.format(name, e))
+        except ValueError as e:
+            errors.append('{}: Invalid input at offset {}: {}'.format(
+                name, e.pos, e.msg))
+    return ''.join(out), errors
+
+
+def print_records(records, keys, fmt, jobs, stats):
+    # Each record is printed as in single document mode, and a newline, in
+    # input order.  Failures are counted in stats.
+    def output(res):
+        out, errors = res
+        sys.stdout.write(out)
+        if errors:
+            sys.stdout.flush()
+            for msg in errors:
+                print(msg, file=sys.stderr)
+            stats.failed += len(errors)
+
+    if jobs == 1:
+        for chunk in chunks(records):
+            stats.records += len(chunk)
+            output(format_records(chunk, keys, fmt))
+        return
+
+    pending = deque()
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        for chunk in chunks(records):
+            stats.records += len(chunk)
+            pending.append(pool.submit(format_records, chunk, keys, fmt))
+            if len(pending) >= jobs * JOB_QUEUE:
+                output(pending.popleft().result())
+        while pending:
+            output(pending.popleft().result())
+
+
+def print_incremental(f):
+    # Returns None once done, or, if the input isn't standard JSON, all of
+    # it for tolerant_loads().  Exits if it's too late for that.
+    reader = Reader(f)
+    held = []
+    held_size = 0
+
+    def write(s):
+        nonlocal held, held_size
+        if held is None:
+            sys.stdout.write(s)
+            return
+        held.append(s)
+        held_size += len(s)
+        if held_size > HOLD_SIZE:
+            sys.stdout.write(''.join(held))
+            held = None
+            reader.kept = None
+
+    try:
+        IncrementalPrinter(reader, write).document()
+    except json.JSONDecodeError as e:
+        if held is None:
+            sys.exit('Invalid JSON at offset {}: {}; run without '
+                     '--incremental to fix it up'.format(
+                         reader.offset + e.pos, e.msg))
+        return ''.join(reader.kept) + f.read()
+
+    if held is not None:
+        sys.stdout.write(''.join(held))
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('file', nargs='?',
+                        help='Input file. Default is standard input.')
+    parser.add_argument('-F', '--format', type=str, default='json',
+                        choices=['python', 'json', 'keys'],
+                        help='Output format')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Print JSON output while reading the input, '
+                             'with bounded memory (single documents in JSON '
+                             'format without keys only)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-l', '--lines', action='store_true',
+                       help='Input has one document per line (JSON Lines)')
+    group.add_argument('-s', '--stream', action='store_true',
+                       help='Input has documents one after another')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Worker processes for --lines and --stream '
+                             '(0 for one per CPU)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the input size and the time and '
+                             'throughput of each phase to stderr')
+    parser.add_argument('key', nargs='*')
+    options = parser.parse_args()
+    fmt = options.format.lower()
+    batch = options.lines or options.stream
+    incremental = options.incremental and fmt == 'json' and \
+        not options.key and not batch
+    stats = Stats()
+
+    # --incremental reads text; otherwise we decode, or map, the bytes
+    if options.file and options.file != '-':
+        f = open(options.file, 'r' if incremental else 'rb')
+    else:
+        f = sys.stdin if incremental else sys.stdin.buffer
+    with f:
+        if batch:
+            jobs = options.jobs or os.cpu_count() or 1
+            if options.lines:
+                records = line_records(f, stats)
+            else:
+                with stats.phase('read'):
+                    records = stream_records(read_input(f, stats))
+            with stats.phase('process'):
+                print_records(records, options.key, fmt, jobs, stats)
+            if options.stats:
+                sys.stdout.flush()
+                stats.report()
+            if stats.failed:
+                sys.exit(1)
+            return
+        if incremental:
+            with stats.phase('print'):
+                src = print_incremental(f)
+            if src is None:
+                if options.stats:
+                    sys.stdout.flush()
+                    stats.report()
+                return
+        else:
+            with stats.phase('read'):
+                src = read_input(f, stats)
+
+    try:
+        with stats.phase('parse'):
+            data = load(src, options.key)
+        with stats.phase('format', rate=False):
+            text = dumps(data, fmt)
+    except KeyError as e:
+        sys.exit('{0} not found'.format(e.args[0]))
+    except TypeError as e:
+        sys.exit(str(e))
+    except ValueError as e:
+        sys.exit('Invalid input at offset {}: {}'.format(e.pos, e.msg))
+    # Like json.dump(), no newline after JSON
+    print(text, end='' if fmt == 'json' else '\n')
+    if options.stats:
+        sys.stdout.flush()
+        stats.report()
 
 
 if __name__ == '__main__':